@@ -0,0 +1,147 @@
+"""Cache of generated answers per client, question and retrieved context"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from embedding_cache import normalize_text
+
+
+def make_context_fingerprint(conversations):
+    """Hash the conversation ids and scores that were fed to the model"""
+    digest = hashlib.sha256()
+    for conv in conversations:
+        score = conv.get("search_score", conv.get("similarity_score", 0)) or 0
+        digest.update(f"{conv['conversation_id']}:{round(score, 4)};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class AnswerCache:
+    """In-process TTL/LRU cache of answers with per-client invalidation
+
+    Exact lookups are keyed by contact_id, normalized question, model id, a
+    fingerprint of the retrieved context and a fingerprint of the chat
+    history the answer followed. Semantic lookups reuse an answer for a
+    near-duplicate question from the same client and history, compared by
+    question embedding.
+    """
+
+    def __init__(self, ttl_seconds=3600, max_entries=500):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._data_versions = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0}
+
+    def _key(self, contact_id, question, model, fingerprint, history=""):
+        return (str(contact_id), normalize_text(question), model, fingerprint, history)
+
+    def _check_version(self, contact_id, data_version):
+        """Drop a client's answers when its data version changes (lock held)"""
+        if data_version is None:
+            return
+        contact_key = str(contact_id)
+        if self._data_versions.get(contact_key, data_version) != data_version:
+            self._invalidate(contact_key)
+        self._data_versions[contact_key] = data_version
+
+    def _invalidate(self, contact_key):
+        stale = [key for key in self._entries if key[0] == contact_key]
+        for key in stale:
+            del self._entries[key]
+        self.stats["invalidations"] += len(stale)
+
+    def _is_expired(self, entry, now):
+        return now - entry["created_at"] > self.ttl_seconds
+
+    def get(
+        self, contact_id, question, model, fingerprint, history="", data_version=None
+    ):
+        """Return the cached answer for this exact question, context and history"""
+        key = self._key(contact_id, question, model, fingerprint, history)
+        now = time.time()
+        with self._lock:
+            self._check_version(contact_id, data_version)
+            entry = self._entries.get(key)
+            if entry is not None and not self._is_expired(entry, now):
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry["answer"]
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+
+    def get_similar(
+        self,
+        contact_id,
+        model,
+        question_embedding,
+        threshold=0.95,
+        history="",
+        data_version=None,
+    ):
+        """Return the answer to the closest cached question from this client
+
+        Only answers that followed the same history and whose question
+        embedding has cosine similarity of at least threshold are reused.
+        """
+        contact_key = str(contact_id)
+        now = time.time()
+        with self._lock:
+            self._check_version(contact_id, data_version)
+            best_key, best_score = None, threshold
+            for key, entry in self._entries.items():
+                if key[0] != contact_key or key[2] != model or key[4] != history:
+                    continue
+                if entry["embedding"] is None or self._is_expired(entry, now):
+                    continue
+                score = _cosine_similarity(question_embedding, entry["embedding"])
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.stats["semantic_hits"] += 1
+            return self._entries[best_key]["answer"]
+
+    def set(
+        self,
+        contact_id,
+        question,
+        model,
+        fingerprint,
+        answer,
+        question_embedding=None,
+        history="",
+        data_version=None,
+    ):
+        """Store an answer (and optionally its question embedding)"""
+        key = self._key(contact_id, question, model, fingerprint, history)
+        with self._lock:
+            self._check_version(contact_id, data_version)
+            self._entries[key] = {
+                "answer": answer,
+                "embedding": question_embedding,
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_stats(self):
+        """Return hit/miss counters and the number of cached answers"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        return stats
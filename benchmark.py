@@ -0,0 +1,587 @@
+"""Offline stage-level benchmark of the question pipeline
+
+Generates a synthetic Hebrew support-chat corpus, loads it into an in-memory
+Mongo stand-in (mongomock, with $vectorSearch and $search emulated), swaps in
+a fake Gemini provider with configurable latencies, and times each pipeline
+stage over a set of questions (and, with --import-time, cold imports of
+functions). Reports p50/p95 latency and peak
+traced memory per stage; results can be saved as a baseline and compared
+against later runs. Needs mongomock (pip install mongomock).
+
+Usage:
+    python benchmark.py --clients 20 --conversations 200 --messages 8
+    python benchmark.py --save-baseline benchmarks/baseline.json
+    python benchmark.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    from mongomock import aggregate as mongomock_aggregate
+except ImportError:  # checked in run()
+    mongomock_aggregate = None
+
+import providers
+from lexical_index import tokenize
+from message_store import build_text_for_embedding, compress_messages, inflate
+
+EMBEDDING_DIMENSIONS = 768
+
+TOPICS = {
+    "withdrawal": [
+        "אני רוצה למשוך כסף מהקרן",
+        "מתי הכסף יגיע לחשבון הבנק שלי?",
+        "המשיכה עדיין בטיפול, איך אפשר לזרז?",
+    ],
+    "deposit": [
+        "העברתי כסף לפני שלושה ימים ולא רואה אותו",
+        "איך מפקידים הוראת קבע חודשית?",
+        "האם אפשר להפקיד סכום חד פעמי נוסף?",
+    ],
+    "fees": [
+        "כמה דמי ניהול אני משלם?",
+        "למה נגבו ממני עמלות החודש?",
+        "האם יש הנחה בדמי הניהול לחיסכון ארוך?",
+    ],
+    "login": [
+        "אני לא מצליח להתחבר לאפליקציה",
+        "לא קיבלתי קוד אימות בהודעה",
+        "שכחתי את הסיסמה לחשבון",
+    ],
+    "tax": [
+        "איך מקבלים אישור מס שנתי?",
+        "האם המשיכה חייבת במס רווחי הון?",
+        "צריך טופס 867 לרואה החשבון",
+    ],
+}
+
+AGENT_REPLIES = [
+    "שלום, תודה שפנית אלינו. אבדוק את הנושא ואחזור אליך.",
+    "בדקתי בחשבון שלך, הבקשה התקבלה ונמצאת בטיפול.",
+    "אפשר לבצע את הפעולה דרך האזור האישי באפליקציה.",
+    "שלחתי לך קישור במייל עם כל הפרטים.",
+    "העברת הכספים לוקחת בדרך כלל עד שלושה ימי עסקים.",
+]
+
+QUESTIONS = [
+    "מה הלקוח שאל לגבי משיכת כספים?",
+    "האם הלקוח התלונן על דמי ניהול?",
+    "אילו בעיות התחברות היו ללקוח?",
+    "מה נאמר לגבי אישור המס?",
+    "מתי הלקוח ביצע הפקדה אחרונה?",
+]
+
+
+def _seeded_vector(text, dimensions):
+    """Deterministic unit vector for a string"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    vector = np.random.default_rng(seed).normal(size=dimensions)
+    return vector / np.linalg.norm(vector)
+
+
+def _topic_of(text):
+    for topic, phrases in TOPICS.items():
+        if any(word in text for phrase in phrases for word in phrase.split()[:2]):
+            return topic
+    return None
+
+
+def embed_text(text, dimensions=EMBEDDING_DIMENSIONS):
+    """Fake embedding: the text's topic direction plus per-text noise"""
+    noise = _seeded_vector(text, dimensions)
+    topic = _topic_of(text)
+    if topic is None:
+        return noise
+    vector = _seeded_vector(topic, dimensions) + 0.6 * noise
+    return vector / np.linalg.norm(vector)
+
+
+def generate_corpus(
+    clients, conversations, messages, dimensions, seed=0, compressed=False
+):
+    """Synthetic conversations: clients x conversations x messages"""
+    rng = random.Random(seed)
+    start = 1_700_000_000_000
+    docs = []
+    for contact_id in range(1, clients + 1):
+        for i in range(conversations):
+            topic = rng.choice(list(TOPICS))
+            start_time = start + (contact_id * conversations + i) * 3_600_000
+            turns = []
+            for m in range(messages):
+                if m % 2 == 0:
+                    turns.append({"role": "user", "content": rng.choice(TOPICS[topic])})
+                else:
+                    turns.append(
+                        {"role": "agent", "content": rng.choice(AGENT_REPLIES)}
+                    )
+            text = "\n".join(f"{t['role']}: {t['content']}" for t in turns)
+            doc = {
+                "conversation_id": f"{contact_id}-{i}",
+                "contact_id": contact_id,
+                "start_time": start_time,
+                "end_time": start_time + 600_000,
+                "embedding": embed_text(text, dimensions).tolist(),
+            }
+            if compressed:
+                doc.update(compress_messages(turns))
+            else:
+                doc.update({"messages": turns, "text_for_embedding": text})
+            docs.append(doc)
+    return docs
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = []
+
+
+class _FakeModels:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        return _FakeResponse(
+            json.dumps({"answer": "הלקוח שאל על משיכה [1][2]", "citations": [1, 2]})
+        )
+
+
+class FakeGenAIClient:
+    """Stands in for google.genai.Client with a fixed structured answer"""
+
+    def __init__(self, latency=0.0):
+        self.models = _FakeModels(latency)
+
+
+class FakeProvider:
+    """Stands in for providers.GeminiProvider with hash-based embeddings"""
+
+    def __init__(
+        self, embedding_latency=0.0, llm_latency=0.0, dimensions=EMBEDDING_DIMENSIONS
+    ):
+        self.embedding_latency = embedding_latency
+        self.dimensions = dimensions
+        self.client = FakeGenAIClient(llm_latency)
+
+    def embed(self, texts, task_type="retrieval_query", model=None):
+        time.sleep(self.embedding_latency)
+        return [embed_text(text, self.dimensions).tolist() for text in texts]
+
+
+# Field carrying the emulated search score until a $project reads it
+SCORE_FIELD = "_search_score"
+
+
+def _has_meta(projection):
+    return any(
+        isinstance(spec, dict) and "$meta" in spec for spec in projection.values()
+    )
+
+
+def _apply_project(doc, projection):
+    result = {}
+    for field, spec in projection.items():
+        if isinstance(spec, dict) and "$meta" in spec:
+            result[field] = doc[SCORE_FIELD]
+        elif isinstance(spec, dict) and "$literal" in spec:
+            result[field] = spec["$literal"]
+        elif spec and field in doc:
+            result[field] = doc[field]
+    return result
+
+
+def _is_emulated(stage):
+    """Stages StandInCollection runs itself instead of passing to mongomock"""
+    if "$unionWith" in stage:
+        return True
+    if "$project" in stage:
+        return _has_meta(stage["$project"])
+    new_root = stage.get("$replaceRoot", {}).get("newRoot")
+    return isinstance(new_root, dict) and "$mergeObjects" in new_root
+
+
+def _merge_objects(doc, parts):
+    """$mergeObjects of field paths and expression documents (not in mongomock)"""
+    merged = {}
+    for part in parts:
+        if isinstance(part, str):
+            merged.update(doc.get(part[1:]) or {})
+        else:
+            merged.update(
+                {
+                    field: mongomock_aggregate._parse_expression(
+                        expression, doc, ignore_missing_keys=True
+                    )
+                    for field, expression in part.items()
+                }
+            )
+    return merged
+
+
+class StandInCollection:
+    """mongomock collection that also answers $vectorSearch and $search
+
+    Search stages are emulated by brute force over the client's documents
+    (cosine similarity, or query term counts over messages) after sleeping
+    search_latency seconds. A $project asking for the score ({"$meta": ...})
+    is applied here, $unionWith runs its sub-pipeline the same way,
+    $replaceRoot over $mergeObjects is merged here, and every other stage is run by mongomock's aggregation engine, which raises
+    NotImplementedError for stages it does not support (so the hybrid
+    pipeline is executed for real, never silently truncated). Every other
+    call goes to mongomock.
+    """
+
+    def __init__(self, collection, search_latency=0.0):
+        self._collection = collection
+        self.search_latency = search_latency
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _vector_hits(self, stage):
+        contact_id = stage["filter"]["contact_id"]["$eq"]
+        docs = list(self._collection.find({"contact_id": contact_id}))
+        if not docs:
+            return []
+        matrix = np.asarray([doc["embedding"] for doc in docs], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        query = np.asarray(stage["queryVector"], dtype=np.float32)
+        scores = matrix @ (query / np.linalg.norm(query))
+        order = np.argsort(-scores)[: stage["limit"]]
+        return [(docs[i], float(scores[i])) for i in order]
+
+    def _text_hits(self, stage):
+        compound = stage["compound"]
+        contact_id = compound["filter"][0]["equals"]["value"]
+        terms = set(tokenize(compound["must"][0]["text"]["query"]))
+        hits = []
+        for doc in self._collection.find({"contact_id": contact_id}):
+            inflate(doc)
+            words = tokenize(" ".join(m["content"] for m in doc["messages"]))
+            score = sum(1 for word in words if word in terms)
+            if score:
+                hits.append((doc, float(score)))
+        return sorted(hits, key=lambda hit: hit[1], reverse=True)
+
+    def _run(self, pipeline):
+        """Run a pipeline starting with a search stage, returning documents"""
+        first = pipeline[0]
+        if "$vectorSearch" in first:
+            hits = self._vector_hits(first["$vectorSearch"])
+        else:
+            hits = self._text_hits(first["$search"])
+        time.sleep(self.search_latency)
+
+        docs = [{**doc, SCORE_FIELD: score} for doc, score in hits]
+        stages = []
+        for stage in pipeline[1:] + [None]:
+            if stage is not None and not _is_emulated(stage):
+                stages.append(stage)
+                continue
+            if stages:
+                docs = list(
+                    mongomock_aggregate.process_pipeline(
+                        docs, self._collection.database, stages, None
+                    )
+                )
+                stages = []
+            if stage is None:
+                break
+            if "$unionWith" in stage:
+                union = stage["$unionWith"]
+                if union["coll"] != self._collection.name:
+                    raise NotImplementedError("$unionWith over another collection")
+                docs += self._run(union["pipeline"])
+            elif "$project" in stage:
+                docs = [_apply_project(doc, stage["$project"]) for doc in docs]
+            else:
+                parts = stage["$replaceRoot"]["newRoot"]["$mergeObjects"]
+                docs = [_merge_objects(doc, parts) for doc in docs]
+        return docs
+
+    def aggregate(self, pipeline):
+        first = pipeline[0]
+        if "$vectorSearch" not in first and "$search" not in first:
+            return self._collection.aggregate(pipeline)
+        return iter(self._run(pipeline))
+
+
+def _import_app():
+    """Import functions and streamlit_app without secrets or API clients"""
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+    os.environ.setdefault("TRACE_LOG_PATH", "")
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import functions
+    import streamlit_app
+
+    return functions, streamlit_app
+
+
+def time_import(module, repeat):
+    """Return [seconds to import module in a fresh interpreter] for each run"""
+    code = (
+        "import time; started = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - started)"
+    )
+    env = dict(os.environ, EMBEDDING_CACHE_PATH="", TRACE_LOG_PATH="")
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def time_stage(fn, repeat):
+    """Return (result, [seconds per run], peak traced bytes of one run)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, timings, peak
+
+
+def run(args):
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("benchmark.py needs mongomock: pip install mongomock")
+
+    stages = {}
+    if args.import_time:
+        print(f"Timing {args.repeat} cold imports of functions")
+        stages["import_functions"] = {
+            "timings": time_import("functions", args.repeat),
+            "peak": 0,
+        }
+
+    functions, app = _import_app()
+    providers.set_provider(
+        FakeProvider(args.embedding_latency, args.llm_latency, args.dimensions)
+    )
+
+    print(
+        f"Generating {args.clients} clients x {args.conversations} conversations "
+        f"x {args.messages} messages ({args.storage} storage)"
+    )
+    collection = mongomock.MongoClient().conversations_db.conversations
+    collection.insert_many(
+        generate_corpus(
+            args.clients,
+            args.conversations,
+            args.messages,
+            args.dimensions,
+            compressed=args.storage == "compressed",
+        )
+    )
+    collection.create_index("contact_id")
+    collection = StandInCollection(collection, args.search_latency)
+
+    def record(name, fn):
+        result, timings, peak = time_stage(fn, args.repeat)
+        stages.setdefault(name, {"timings": [], "peak": 0})
+        stages[name]["timings"].extend(timings)
+        stages[name]["peak"] = max(stages[name]["peak"], peak)
+        return result
+
+    n = args.n
+    for q, question in enumerate(QUESTIONS):
+        contact_id = q % args.clients + 1
+        record("get_all_clients", lambda: functions.get_all_clients(collection))
+
+        def embed():
+            functions.embedding_cache.clear()
+            return functions.get_embedding(question)
+
+        embedding = record("get_embedding", embed)
+
+        # The path the app takes, in the configured RETRIEVAL_MODE (one
+        # hybrid aggregation by default), from embedding to hydrated hits
+        def retrieve():
+            functions.embedding_cache.clear()
+            return functions.retrieve_conversations(collection, question, contact_id, n)
+
+        record("retrieve_conversations", retrieve)
+        vector_hits = record(
+            "vector_search",
+            lambda: functions.vector_search(collection, embedding, contact_id, n),
+        )
+        text_hits = record(
+            "text_search",
+            lambda: functions.text_search(collection, question, contact_id, n),
+        )
+        record(
+            "local_vector_search",
+            lambda: functions.local_vector_search(collection, embedding, contact_id, n),
+        )
+        record(
+            "local_text_search",
+            lambda: functions.local_text_search(collection, question, contact_id, n),
+        )
+        hits = record(
+            "fusion",
+            lambda: functions.merge_search_results(vector_hits, text_hits, n),
+        )
+        hits = record(
+            "rerank", lambda: functions.rerank_hits(collection, hits, contact_id)
+        )
+        conversations = record(
+            "hydrate",
+            lambda: functions.hydrate_conversations(collection, hits, contact_id),
+        )
+        context = record(
+            "format_context", lambda: functions.format_context(conversations)
+        )
+        record("build_prompt", lambda: functions.build_prompt(question, context))
+        record("generate", lambda: functions.get_gemini_response(question, context))
+        record("format_context_display", lambda: app.format_context_display(context))
+        raw = [
+            {**conv, "text_for_embedding": build_text_for_embedding(conv["messages"])}
+            for conv in conversations
+        ]
+        record("format_raw_context", lambda: app.format_raw_context(raw))
+
+    return {
+        "config": {
+            "clients": args.clients,
+            "conversations": args.conversations,
+            "messages": args.messages,
+            "dimensions": args.dimensions,
+            "storage": args.storage,
+            "retrieval_mode": functions.RETRIEVAL_MODE,
+            "n": args.n,
+            "repeat": args.repeat,
+            "embedding_latency": args.embedding_latency,
+            "search_latency": args.search_latency,
+            "llm_latency": args.llm_latency,
+            "import_time": args.import_time,
+        },
+        "stages": {
+            name: {
+                "p50_ms": round(statistics.median(s["timings"]) * 1000, 3),
+                "p95_ms": round(percentile(s["timings"], 0.95) * 1000, 3),
+                "peak_kib": round(s["peak"] / 1024, 1),
+            }
+            for name, s in stages.items()
+        },
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Return the stages whose p50 regressed beyond tolerance"""
+    regressions = []
+    for name, stage in results["stages"].items():
+        before = baseline["stages"].get(name)
+        if not before:
+            continue
+        delta = stage["p50_ms"] - before["p50_ms"]
+        if delta > min_delta_ms and stage["p50_ms"] > before["p50_ms"] * (
+            1 + tolerance
+        ):
+            regressions.append((name, before["p50_ms"], stage["p50_ms"]))
+    return regressions
+
+
+def print_report(results, baseline=None):
+    print(f"{'stage':<24}{'p50 ms':>10}{'p95 ms':>10}{'peak KiB':>11}{'base p50':>10}")
+    for name, stage in results["stages"].items():
+        base = ""
+        if baseline and name in baseline["stages"]:
+            base = f"{baseline['stages'][name]['p50_ms']:.3f}"
+        print(
+            f"{name:<24}{stage['p50_ms']:>10.3f}{stage['p95_ms']:>10.3f}"
+            f"{stage['peak_kib']:>11.1f}{base:>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=8)
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    parser.add_argument("--storage", choices=("plain", "compressed"), default="plain")
+    parser.add_argument("--n", type=int, default=100, help="hits per search branch")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage")
+    parser.add_argument("--embedding-latency", type=float, default=0.0)
+    parser.add_argument("--search-latency", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="also time cold imports of functions in fresh interpreters",
+    )
+    parser.add_argument("--save-baseline", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed p50 slowdown per stage before failing --compare",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=1.0,
+        help="ignore p50 slowdowns smaller than this",
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or ".", exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    if baseline:
+        if baseline["config"] != results["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for name, before, after in regressions:
+            print(f"Regression in {name}: p50 {before:.3f} ms -> {after:.3f} ms")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Structured answer output and index-based citation resolution"""
+
+import json
+import re
+
+# Gemini response schema: the answer text (with inline [i] markers) followed
+# by the list of cited conversation numbers
+ANSWER_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "answer": {"type": "STRING"},
+        "citations": {"type": "ARRAY", "items": {"type": "INTEGER"}},
+    },
+    "required": ["answer", "citations"],
+    "property_ordering": ["answer", "citations"],
+}
+
+SOURCES_HEADER = "מקורות:"
+
+_JSON_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+
+class AnswerStreamDecoder:
+    """Incrementally extract the "answer" string from streamed JSON output
+
+    Feed raw chunks as they arrive; each call returns the newly decoded part
+    of the answer so it can be rendered before the JSON is complete.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = None
+        self._done = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self._done:
+            return ""
+        if self._pos is None:
+            match = re.search(r'"answer"\s*:\s*"', self.buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        decoded = []
+        buffer = self.buffer
+        i = self._pos
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self._done = True
+                i += 1
+                break
+            if char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+
+            # Escape sequence; wait for more input if it is incomplete
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape != "u":
+                decoded.append(_JSON_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            if i + 6 > len(buffer):
+                break
+            code = int(buffer[i + 2 : i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # Surrogate pair: needs the low half as well
+                if i + 12 > len(buffer):
+                    break
+                low = int(buffer[i + 8 : i + 12], 16)
+                code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                i += 12
+            else:
+                i += 6
+            decoded.append(chr(code))
+
+        self._pos = i
+        return "".join(decoded)
+
+
+def _unique_ints(values):
+    seen = []
+    for value in values:
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            continue
+        if value not in seen:
+            seen.append(value)
+    return seen
+
+
+def parse_answer(text):
+    """Split model output into (answer, citations)
+
+    Structured JSON output is parsed directly. Plain text output falls back
+    to the legacy format: the answer before "מקורות:" and the [n] numbers
+    listed after it (or, without a sources block, cited inline).
+    """
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and "answer" in data:
+            return data["answer"], _unique_ints(data.get("citations") or [])
+    except (TypeError, ValueError):
+        pass
+
+    parts = text.split(SOURCES_HEADER)
+    answer = parts[0].strip()
+    sources = parts[1] if len(parts) > 1 else answer
+    return answer, _unique_ints(re.findall(r"\[(\d+)\]", sources))
+
+
+def build_citation_index(context):
+    """Map conversation numbers (1-based positions in context) to conversations"""
+    return {index: conv for index, conv in enumerate(context, start=1)}
+
+
+def resolve_citations(citations, context):
+    """Return (number, conversation) pairs for the cited conversations"""
+    index = build_citation_index(context)
+    return [(number, index[number]) for number in citations if number in index]
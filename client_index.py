@@ -0,0 +1,209 @@
+"""Materialized per-client summary collection backing the client picker"""
+
+import re
+import threading
+import time
+from datetime import timedelta
+
+from pymongo import ASCENDING, DESCENDING
+
+import tracing
+
+
+def _summary_stages():
+    """Group conversations into one summary document per client"""
+    return [
+        {
+            "$group": {
+                "_id": "$contact_id",
+                "conversation_count": {"$sum": 1},
+                "first_activity": {"$min": "$start_time"},
+                "last_activity": {"$max": "$end_time"},
+            }
+        },
+        {"$set": {"contact_id": "$_id", "contact_id_str": {"$toString": "$_id"}}},
+    ]
+
+
+class ClientIndex:
+    """Maintains the clients summary collection and serves cached pages of it
+
+    The summary (conversation count, first/last activity per contact_id) is
+    built once with an aggregation. Refreshes then recompute the summaries of
+    the clients with conversations written since the last refresh watermark
+    (by their updated_at, which ingest sets on every write) and replace them.
+    Both run in a background thread (see start()) or from ingest.py, never
+    while serving a page. get_db returns the database holding the conversations (named
+    conversations_name), clients and client_index_state collections.
+    """
+
+    # Writes that commit out of updated_at order are caught by re-reading
+    # this far behind the watermark; recomputing a summary is idempotent
+    WATERMARK_OVERLAP = timedelta(minutes=5)
+
+    def __init__(
+        self,
+        get_db,
+        conversations_name="conversations",
+        ttl_seconds=60,
+        refresh_interval=300,
+    ):
+        self.get_db = get_db
+        self.conversations_name = conversations_name
+        self.ttl_seconds = ttl_seconds
+        self.refresh_interval = refresh_interval
+        self._pages = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Collections are looked up on each use so a replaced client is picked up
+    @property
+    def conversations(self):
+        return self.get_db()[self.conversations_name]
+
+    @property
+    def clients(self):
+        return self.get_db().clients
+
+    @property
+    def state(self):
+        return self.get_db().client_index_state
+
+    def _get_state(self):
+        return self.state.find_one({"_id": "clients"})
+
+    def _latest_update(self):
+        latest = self.conversations.find_one(
+            {}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", DESCENDING)]
+        )
+        return latest.get("updated_at") if latest else None
+
+    def ensure_indexes(self):
+        """Create the indexes used for refreshing, searching and paging"""
+        self.conversations.create_index([("updated_at", DESCENDING)])
+        self.clients.create_index([("contact_id", ASCENDING)])
+        self.clients.create_index([("contact_id_str", ASCENDING)])
+        self.clients.create_index([("last_activity", DESCENDING)])
+
+    def rebuild(self):
+        """Rebuild the whole summary collection from conversations"""
+        # $out keeps the indexes of the collection it replaces
+        self.ensure_indexes()
+        watermark = self._latest_update()
+        self.conversations.aggregate(_summary_stages() + [{"$out": self.clients.name}])
+        self.state.replace_one(
+            {"_id": "clients"}, {"_id": "clients", "watermark": watermark}, upsert=True
+        )
+        self.invalidate()
+
+    def refresh(self):
+        """Recompute the summaries of clients written to since the last refresh"""
+        state = self._get_state()
+        if state is None:
+            self.rebuild()
+            return
+
+        watermark = state["watermark"]
+        new_watermark = self._latest_update()
+        if new_watermark is None or (
+            watermark is not None and new_watermark <= watermark
+        ):
+            return
+
+        query = {"updated_at": {"$exists": True}}
+        if watermark is not None:
+            query = {"updated_at": {"$gte": watermark - self.WATERMARK_OVERLAP}}
+        contact_ids = self.conversations.distinct("contact_id", query)
+        if contact_ids:
+            self.conversations.aggregate(
+                [{"$match": {"contact_id": {"$in": contact_ids}}}]
+                + _summary_stages()
+                + [
+                    {
+                        "$merge": {
+                            "into": self.clients.name,
+                            "on": "_id",
+                            "whenMatched": "replace",
+                            "whenNotMatched": "insert",
+                        }
+                    }
+                ]
+            )
+        self.state.update_one(
+            {"_id": "clients"}, {"$set": {"watermark": new_watermark}}
+        )
+        self.invalidate()
+
+    def start(self):
+        """Refresh in a daemon thread now and every refresh_interval seconds
+
+        Keeps the rebuild and refresh aggregations off the request path;
+        get_page only reads the summary. Does nothing if already started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._refresh_forever, name="client-index", daemon=True
+            )
+        self._thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                tracing.report_error("Client index refresh", e)
+            time.sleep(self.refresh_interval)
+
+    def get_page(self, search="", page=0, page_size=50):
+        """Return (contact_ids, total) for one page of clients matching search
+
+        search is matched as a prefix of the contact id.
+        """
+        key = (search, page, page_size)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached and now - cached[0] < self.ttl_seconds:
+                return cached[1]
+
+        # Until the first rebuild succeeds, page through the conversations
+        if self._get_state() is None:
+            result = self._distinct_page(search, page, page_size)
+        else:
+            result = self._summary_page(search, page, page_size)
+
+        with self._lock:
+            self._pages[key] = (now, result)
+        return result
+
+    def _summary_page(self, search, page, page_size):
+        query = {}
+        if search:
+            query["contact_id_str"] = {"$regex": f"^{re.escape(search)}"}
+        ids = [
+            int(doc["contact_id"])
+            for doc in self.clients.find(query, {"_id": 0, "contact_id": 1})
+            .sort("contact_id", ASCENDING)
+            .skip(page * page_size)
+            .limit(page_size)
+        ]
+        return ids, self.clients.count_documents(query)
+
+    def _distinct_page(self, search, page, page_size):
+        """Page through distinct contact ids while the summary is not built"""
+        ids = sorted(int(cid) for cid in self.conversations.distinct("contact_id"))
+        if search:
+            ids = [cid for cid in ids if str(cid).startswith(search)]
+        offset = page * page_size
+        return ids[offset : offset + page_size], len(ids)
+
+    def get_summary(self, contact_id):
+        """Return the summary document for one client"""
+        return self.clients.find_one({"contact_id": contact_id}, {"_id": 0})
+
+    def invalidate(self):
+        """Drop cached pages"""
+        with self._lock:
+            self._pages.clear()
@@ -0,0 +1,95 @@
+"""Per-client Gemini cached content holding a client's conversation archive"""
+
+import threading
+import time
+
+import tracing
+from single_flight import SingleFlight
+
+CORPUS_INSTRUCTION = (
+    "אתה מנתח שיחות תמיכה של 'fair: קרנות נאמנות אונליין'. "
+    "התוכן השמור הוא ארכיון השיחות של לקוח אחד; כל שורה היא שיחה ב-JSON מקוצר: "
+    'id=מזהה שיחה, t=תאריך, m=הודעות כזוגות [תפקיד, תוכן] כאשר "c"=לקוח ו-"a"=נציג.'
+)
+
+
+class ClientContextCache:
+    """Uploads each client's archive once as Gemini cached content and reuses it
+
+    Entries are keyed by contact_id and tied to the client's data version:
+    when the version changes (or the TTL runs out) a new cache is created and
+    the old one deleted. Building and uploading an archive happen outside the
+    lock, coalesced per client and version, so a slow upload for one client
+    does not hold up the others. get_client is called on use and returns the
+    genai client, which only needs a `caches` attribute with `create` and
+    `delete`, so a fake client can stand in for it.
+    """
+
+    def __init__(self, get_client, model, ttl_seconds=1800):
+        self.get_client = get_client
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight("context_cache")
+
+    def _delete(self, entry):
+        if entry and entry["name"]:
+            try:
+                self.get_client().caches.delete(name=entry["name"])
+            except Exception as e:
+                tracing.report_error("Context cache delete", e)
+
+    def _create(self, key, data_version, build_corpus):
+        """Build and upload a client's archive, then swap it in for the old entry"""
+        entry = {
+            "name": None,
+            "conversation_ids": set(),
+            "data_version": data_version,
+            "expires_at": time.time() + self.ttl_seconds,
+        }
+        try:
+            from google.genai.types import CreateCachedContentConfig
+
+            corpus_text, conversation_ids = build_corpus()
+            cached = self.get_client().caches.create(
+                model=self.model,
+                config=CreateCachedContentConfig(
+                    contents=[corpus_text],
+                    system_instruction=CORPUS_INSTRUCTION,
+                    display_name=f"client-{key}",
+                    ttl=f"{int(self.ttl_seconds)}s",
+                ),
+            )
+            entry["name"] = cached.name
+            entry["conversation_ids"] = set(conversation_ids)
+        except Exception as e:
+            tracing.report_error("Context cache create", e)
+
+        with self._lock:
+            previous = self._entries.get(key)
+            self._entries[key] = entry
+        self._delete(previous)
+        return entry
+
+    def get_or_create(self, contact_id, data_version, build_corpus):
+        """Return the cache entry for a client, creating it if needed
+
+        build_corpus() is only called on a miss and must return
+        (corpus_text, conversation_ids). Returns a dict with the cache "name"
+        and the set of cached "conversation_ids", or None if the archive could
+        not be cached (e.g. too small for context caching); that outcome is
+        remembered until the data version changes.
+        """
+        key = str(contact_id)
+        with self._lock:
+            entry = self._entries.get(key)
+        if not (
+            entry
+            and entry["data_version"] == data_version
+            and entry["expires_at"] > time.time()
+        ):
+            entry = self._flights.do(
+                (key, data_version), self._create, key, data_version, build_corpus
+            )
+        return entry if entry["name"] else None
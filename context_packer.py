@@ -0,0 +1,239 @@
+"""Token-budgeted packing of retrieved conversations into the prompt"""
+
+import json
+import math
+import re
+from datetime import datetime
+
+# Rough characters-per-token ratio for mixed Hebrew/English chat text
+CHARS_PER_TOKEN = 3.0
+
+USER_ROLES = ["user", "customer", "client", "human"]
+
+# Legend for the compact keys, placed in the prompt above the packed context
+CONTEXT_LEGEND = (
+    "כל שיחה מיוצגת כ-JSON מקוצר: "
+    "i=מספר השיחה לציטוט, t=תאריך, s=ציון התאמה, "
+    'm=הודעות כזוגות [תפקיד, תוכן] כאשר "c"=לקוח ו-"a"=נציג, '
+    '"…" מסמן הודעות שהושמטו'
+)
+
+
+def estimate_tokens(text):
+    """Cheap up-front token estimate that needs no API call"""
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def _query_terms(question):
+    """Words from the question that are long enough to be worth matching"""
+    return {word for word in re.findall(r"\w+", question.casefold()) if len(word) > 2}
+
+
+def _short_role(role):
+    role = role.lower()
+    return "c" if any(user_role in role for user_role in USER_ROLES) else "a"
+
+
+def truncate_conversation(messages, terms, max_messages=12):
+    """Keep up to max_messages messages around the ones matching the question
+
+    The window around the matching messages (or the opening of the
+    conversation, without matches) widens until max_messages are kept.
+    Returns the kept messages, with "…" markers where messages were skipped,
+    and whether anything was dropped.
+    """
+    if len(messages) <= max_messages:
+        return list(messages), False
+
+    matches = [
+        i
+        for i, msg in enumerate(messages)
+        if terms and terms & set(re.findall(r"\w+", msg["content"].casefold()))
+    ]
+    # Without matches, keep the opening of the conversation
+    if not matches:
+        matches = [0]
+
+    keep = set(matches[:max_messages])
+    distance = 1
+    while len(keep) < max_messages:
+        for i in matches:
+            for j in (i - distance, i + distance):
+                if 0 <= j < len(messages) and len(keep) < max_messages:
+                    keep.add(j)
+        distance += 1
+
+    kept = []
+    previous = -1
+    for i in sorted(keep):
+        if i != previous + 1:
+            kept.append({"role": "…", "content": "…"})
+        kept.append(messages[i])
+        previous = i
+    if previous != len(messages) - 1:
+        kept.append({"role": "…", "content": "…"})
+    return kept, True
+
+
+def compact_conversation(index, conv, messages):
+    """Serialize one conversation with short keys and no whitespace"""
+    compact = {
+        "i": index,
+        "t": conv["timestamp"][:10],
+        "s": conv["similarity_score"],
+        "m": [
+            (
+                ["…", "…"]
+                if msg["role"] == "…"
+                else [_short_role(msg["role"]), msg["content"]]
+            )
+            for msg in messages
+        ],
+    }
+    return json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+
+
+def _fit_conversation(index, conv, terms, room, max_messages, token_counter):
+    """Serialize a conversation whole if it fits in room tokens, else truncated
+
+    Returns (line, tokens, was_truncated).
+    """
+    line = compact_conversation(index, conv, conv["conversation"])
+    line_tokens = token_counter(line)
+    if line_tokens <= room:
+        return line, line_tokens, False
+    messages, was_truncated = truncate_conversation(
+        conv["conversation"], terms, max_messages=max_messages
+    )
+    if not was_truncated:
+        return line, line_tokens, False
+    line = compact_conversation(index, conv, messages)
+    return line, token_counter(line), True
+
+
+def build_corpus(conversations, token_budget=500000, token_counter=estimate_tokens):
+    """Serialize a client's full archive, newest conversations first
+
+    conversations are raw conversation documents. Returns (corpus_text,
+    conversation_ids) for the conversations that fit in token_budget.
+    """
+    lines = []
+    conversation_ids = []
+    used_tokens = 0
+    for conv in sorted(conversations, key=lambda c: c["start_time"], reverse=True):
+        compact = {
+            "id": conv["conversation_id"],
+            "t": datetime.fromtimestamp(conv["start_time"] / 1000).strftime("%Y-%m-%d"),
+            "m": [
+                [_short_role(msg["role"]), msg["content"]]
+                for msg in conv["messages"]
+                if not msg.get("quick_replies")
+            ],
+        }
+        line = json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+        line_tokens = token_counter(line)
+        if used_tokens + line_tokens > token_budget:
+            break
+        lines.append(line)
+        conversation_ids.append(conv["conversation_id"])
+        used_tokens += line_tokens
+    return "\n".join(lines), conversation_ids
+
+
+def pack_context(
+    context,
+    question,
+    token_budget=30000,
+    max_messages=12,
+    token_counter=estimate_tokens,
+    skip_ids=None,
+    start=1,
+):
+    """Greedily pack the highest-scoring conversations into a token budget
+
+    context is the output of format_context(). Conversations are numbered by
+    their position in context (starting at start) so citations stay stable no
+    matter which ones were dropped. Conversations whose id is in skip_ids
+    (e.g. already in a cached corpus) are not serialized. Returns a dict with
+    the packed text and a report of what was included, truncated and dropped.
+    A conversation is truncated to max_messages only when it does not fit the
+    remaining budget whole.
+    """
+    terms = _query_terms(question)
+    ranked = sorted(
+        enumerate(context, start=start),
+        key=lambda item: item[1]["similarity_score"],
+        reverse=True,
+    )
+
+    lines = []
+    included = []
+    truncated = []
+    dropped = []
+    used_tokens = 0
+    for index, conv in ranked:
+        if skip_ids and conv["conversation_id"] in skip_ids:
+            continue
+        line, line_tokens, was_truncated = _fit_conversation(
+            index,
+            conv,
+            terms,
+            token_budget - used_tokens,
+            max_messages,
+            token_counter,
+        )
+        if used_tokens + line_tokens > token_budget:
+            dropped.append(conv["conversation_id"])
+            continue
+
+        lines.append((index, line))
+        used_tokens += line_tokens
+        included.append(conv["conversation_id"])
+        if was_truncated:
+            truncated.append(conv["conversation_id"])
+
+    # Present the packed conversations in their original order
+    lines.sort()
+    return {
+        "text": "\n".join(line for _, line in lines),
+        "tokens": used_tokens,
+        "included": included,
+        "truncated": truncated,
+        "dropped": dropped,
+    }
+
+
+def chunk_context(
+    context, question, chunk_tokens, max_messages=12, token_counter=estimate_tokens
+):
+    """Split context into consecutive chunks that each pack into chunk_tokens
+
+    Returns (start, conversations, tokens) for each chunk, start being the
+    number of its first conversation, so packing a chunk with
+    pack_context(start=start) keeps the numbering of the whole context.
+    """
+    terms = _query_terms(question)
+    chunks = []
+    current = []
+    start = 1
+    used_tokens = 0
+    for index, conv in enumerate(context, start=1):
+        _, line_tokens, _ = _fit_conversation(
+            index,
+            conv,
+            terms,
+            chunk_tokens - used_tokens,
+            max_messages,
+            token_counter,
+        )
+        if current and used_tokens + line_tokens > chunk_tokens:
+            chunks.append((start, current, used_tokens))
+            start, current, used_tokens = index, [], 0
+            _, line_tokens, _ = _fit_conversation(
+                index, conv, terms, chunk_tokens, max_messages, token_counter
+            )
+        current.append(conv)
+        used_tokens += line_tokens
+    if current:
+        chunks.append((start, current, used_tokens))
+    return chunks
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Normalize text so trivially different questions share a cache key"""
+    text = unicodedata.normalize("NFC", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.casefold()
+
+
+def make_cache_key(text, model, task_type):
+    """Build a stable cache key from normalized text, model and task type"""
+    raw = "\x1f".join([model, task_type or "", normalize_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-memory LRU in front of a SQLite store"""
+
+    def __init__(
+        self,
+        path=None,
+        memory_size=1024,
+        max_entries=100000,
+        max_age_seconds=30 * 24 * 3600,
+    ):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes_since_prune = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def _has_db(self):
+        """Open the persistent store on first use (caller must hold the lock)"""
+        if self._db is None and self.path:
+            self._open_db()
+        return self._db is not None
+
+    def _open_db(self):
+        """Open (and create if needed) the persistent store"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)"
+        )
+        self._db.commit()
+
+    def _is_expired(self, created_at, now):
+        return (
+            self.max_age_seconds is not None and now - created_at > self.max_age_seconds
+        )
+
+    def _remember(self, key, vector, created_at):
+        """Insert into the in-memory LRU (caller must hold the lock)"""
+        self._memory[key] = (vector, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, text, model, task_type):
+        """Return the cached embedding or None"""
+        key = make_cache_key(text, model, task_type)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                vector, created_at = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return list(vector)
+                del self._memory[key]
+
+            if self._has_db():
+                row = self._db.execute(
+                    "SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    blob, created_at = row
+                    if self._is_expired(created_at, now):
+                        self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                        self._db.commit()
+                    else:
+                        vector = array("f")
+                        vector.frombytes(blob)
+                        self._db.execute(
+                            "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                            (now, key),
+                        )
+                        self._db.commit()
+                        self._remember(key, vector, created_at)
+                        self.stats["disk_hits"] += 1
+                        return list(vector)
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, text, model, task_type, embedding):
+        """Store an embedding in both tiers"""
+        key = make_cache_key(text, model, task_type)
+        now = time.time()
+        vector = array("f", embedding)
+        with self._lock:
+            self._remember(key, vector, now)
+            if self._has_db():
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, vector.tobytes(), now, now),
+                )
+                self._db.commit()
+                self._writes_since_prune += 1
+                if self._writes_since_prune >= 100:
+                    self._prune()
+
+    def _prune(self):
+        """Evict expired and least recently used rows (caller must hold the lock)"""
+        self._writes_since_prune = 0
+        removed = 0
+        if self.max_age_seconds is not None:
+            cursor = self._db.execute(
+                "DELETE FROM embeddings WHERE created_at < ?",
+                (time.time() - self.max_age_seconds,),
+            )
+            removed += cursor.rowcount
+        if self.max_entries is not None:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                cursor = self._db.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                removed += cursor.rowcount
+        self._db.commit()
+        self.stats["evictions"] += removed
+
+    def prune(self):
+        """Apply size and age eviction to the persistent store"""
+        with self._lock:
+            if self._has_db():
+                self._prune()
+
+    def clear(self):
+        """Drop every cached embedding"""
+        with self._lock:
+            self._memory.clear()
+            if self._has_db():
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def get_stats(self):
+        """Return hit/miss counters and tier sizes"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+            if self._has_db():
+                (stats["disk_entries"],) = self._db.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = hits / total if total else 0.0
+        return stats
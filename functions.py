@@ -1,52 +1,555 @@
+import hashlib
 import os
+from array import array
 from datetime import datetime
-import json
-from pymongo import MongoClient
-from google import genai
-import google.generativeai as genaiEmb
-from google.genai.types import Tool, GenerateContentConfig, GoogleSearch
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 # from dotenv import load_dotenv
-import streamlit as st
+import tracing
+from tracing import traced, report_error
+from mongo import MongoConnectionManager
+from embedding_cache import EmbeddingCache, normalize_text
+from answer_cache import AnswerCache, make_context_fingerprint
+from citations import ANSWER_SCHEMA, AnswerStreamDecoder, parse_answer
+from client_index import ClientIndex
+from context_cache import ClientContextCache
+from context_packer import (
+    build_corpus,
+    chunk_context,
+    pack_context,
+    estimate_tokens,
+    CONTEXT_LEGEND,
+)
+from hybrid_search import (
+    build_hybrid_pipeline,
+    build_text_search_stage,
+    LEAN_PROJECTION,
+    HYDRATE_PROJECTION,
+)
+from vector_index import LocalVectorIndex
+from message_store import inflate, payload_bytes
+from lexical_index import LocalTextIndex
+from rerank import mmr_rerank
+from providers import EMBEDDING_MODEL, get_provider, require_setting
+from rate_limit import RateLimiter, RateLimitTimeout, is_retryable
+from single_flight import SingleFlight
 
 # Load environment variables
 # load_dotenv()
 
-# Configure API keys and clients
-# GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-# MONGODB_URI = os.getenv("MONGODB_URI")
-GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-MONGODB_URI = st.secrets["MONGODB_URI"]
+# API keys and clients are resolved on first use (see providers.py):
+# GEMINI_API_KEY and MONGODB_URI come from the environment or st.secrets
+
+# MongoDB connection pool settings (one pooled client per worker process)
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")
+)
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000"))
+MONGODB_HEALTH_CHECK_INTERVAL = float(os.getenv("MONGODB_HEALTH_CHECK_INTERVAL", "30"))
+
+# Embedding cache settings (set EMBEDDING_CACHE_PATH="" for memory-only)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "1024"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+EMBEDDING_CACHE_MAX_AGE_DAYS = float(os.getenv("EMBEDDING_CACHE_MAX_AGE_DAYS", "30"))
+
+# Concurrent retrieval settings (per-branch deadlines in seconds)
+RETRIEVAL_MAX_WORKERS = int(os.getenv("RETRIEVAL_MAX_WORKERS", "16"))
+RETRIEVAL_VECTOR_TIMEOUT = float(os.getenv("RETRIEVAL_VECTOR_TIMEOUT", "8"))
+RETRIEVAL_TEXT_TIMEOUT = float(os.getenv("RETRIEVAL_TEXT_TIMEOUT", "8"))
+
+# Retrieval mode: "hybrid" fuses both branches server-side in one aggregation,
+# "merge" runs the branches separately and keeps each conversation's max score,
+# "local" runs both branches in-process instead of with $vectorSearch/$search
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RETRIEVAL_FUSION = os.getenv("RETRIEVAL_FUSION", "rrf")
+
+# In-process vector and BM25 indexes: fallbacks for $vectorSearch/$search, and
+# the primary branches for clients with at most LOCAL_INDEX_MAX_DOCS
+# conversations (0 = off)
+LOCAL_INDEX_MAX_DOCS = int(os.getenv("LOCAL_INDEX_MAX_DOCS", "0"))
+LOCAL_INDEX_MAX_CLIENTS = int(os.getenv("LOCAL_INDEX_MAX_CLIENTS", "32"))
+LOCAL_VECTOR_TTL = float(os.getenv("LOCAL_VECTOR_TTL", "300"))
+LOCAL_TEXT_REFRESH_INTERVAL = float(os.getenv("LOCAL_TEXT_REFRESH_INTERVAL", "60"))
+
+# MMR reranking: keep the RERANK_TOP_K most relevant yet diverse conversations
+# (0 = off); RERANK_LAMBDA=1 is pure relevance, lower values favour diversity
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "40"))
+RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.7"))
+# MMR needs one embedding per candidate: free when the client's local vector
+# matrix is cached, otherwise a find() returning ~10 KB of BSON per 768-dim
+# embedding. So only the top RERANK_CANDIDATES hits are reranked, and only when
+# there are at least RERANK_MIN_EXTRA more hits than RERANK_TOP_K; with fewer,
+# the hits are just cut to RERANK_TOP_K
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "60"))
+RERANK_MIN_EXTRA = int(os.getenv("RERANK_MIN_EXTRA", "10"))
+
+# Prompt context budget (estimated tokens for the packed conversations)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "30000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "12"))
+
+# Map-reduce answering for context that does not fit CONTEXT_TOKEN_BUDGET:
+# chunks of MAP_REDUCE_CHUNK_TOKENS are extracted concurrently, then merged
+MAP_REDUCE_ENABLED = os.getenv("MAP_REDUCE_ENABLED", "0") == "1"
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", "12000"))
+MAP_REDUCE_MAX_CHUNKS = int(os.getenv("MAP_REDUCE_MAX_CHUNKS", "8"))
+MAP_REDUCE_MAX_WORKERS = int(os.getenv("MAP_REDUCE_MAX_WORKERS", "4"))
+MAP_REDUCE_TIMEOUT = float(os.getenv("MAP_REDUCE_TIMEOUT", "60"))
+
+# Answer cache settings (semantic mode reuses answers for near-duplicate questions)
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "0") == "1"
+ANSWER_CACHE_SEMANTIC_THRESHOLD = float(
+    os.getenv("ANSWER_CACHE_SEMANTIC_THRESHOLD", "0.95")
+)
+
+# Client picker settings (materialized clients summary collection, refreshed
+# by a background thread every CLIENT_INDEX_REFRESH_INTERVAL seconds; 0 leaves
+# it to ingest.py --refresh-clients)
+CLIENT_INDEX_TTL = float(os.getenv("CLIENT_INDEX_TTL", "60"))
+CLIENT_INDEX_REFRESH_INTERVAL = float(os.getenv("CLIENT_INDEX_REFRESH_INTERVAL", "300"))
+CLIENT_PAGE_SIZE = int(os.getenv("CLIENT_PAGE_SIZE", "50"))
+
+# Structured output: answer text plus cited conversation numbers as JSON
+STRUCTURED_CITATIONS = os.getenv("STRUCTURED_CITATIONS", "1") == "1"
+
+# Chat history sent to Gemini: recent messages verbatim, older ones summarized
+HISTORY_RECENT_MESSAGES = int(os.getenv("HISTORY_RECENT_MESSAGES", "4"))
+HISTORY_TOKEN_CAP = int(os.getenv("HISTORY_TOKEN_CAP", "2000"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "400"))
+
+# Request tracing: JSONL log of question traces (off unless a path is set, as
+# nothing rotates it) and the admin sidebar panel with the breakdown of the
+# last TRACE_PANEL_SIZE questions
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "")
+ADMIN_PANEL = os.getenv("ADMIN_PANEL", "0") == "1"
+TRACE_PANEL_SIZE = int(os.getenv("TRACE_PANEL_SIZE", "10"))
+
+# Gemini quota: per-process request/token rate limits (0 = unlimited), a cap
+# on calls in flight and jittered exponential retries of 429/5xx responses
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+EMBEDDING_RPM = int(os.getenv("EMBEDDING_RPM", "0"))
+EMBEDDING_TPM = int(os.getenv("EMBEDDING_TPM", "0"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "20"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30"))
+
+# Identical requests in flight at the same time (e.g. a team asking the same
+# question about one client) share one embedding, retrieval and answer;
+# followers of a streamed answer give up on the leader after the timeout
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+COALESCE_ANSWER_TIMEOUT = float(os.getenv("COALESCE_ANSWER_TIMEOUT", "120"))
+
+# Per-client Gemini context caching of the whole conversation archive
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "0") == "1"
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "1800"))
+CONTEXT_CACHE_MAX_TOKENS = int(os.getenv("CONTEXT_CACHE_MAX_TOKENS", "500000"))
 
-genaiEmb.configure(api_key=GEMINI_API_KEY)
-client = genai.Client(api_key=GEMINI_API_KEY)
 model_id = "gemini-2.0-flash-exp"
 # model_id = "gemini-1.5-pro"
 
-# Initialize Google Search tool
-google_search_tool = Tool(google_search=GoogleSearch())
+
+def genai_client():
+    """The google.genai client of the current provider (created on first use)"""
+    return get_provider().client
+
+
+trace_log = tracing.TraceLog(TRACE_LOG_PATH or None)
+
+generation_limiter = RateLimiter(
+    "Gemini",
+    requests_per_minute=GEMINI_RPM,
+    tokens_per_minute=GEMINI_TPM,
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    max_retries=GEMINI_MAX_RETRIES,
+    base_delay=GEMINI_RETRY_BASE_DELAY,
+    max_delay=GEMINI_RETRY_MAX_DELAY,
+    queue_timeout=GEMINI_QUEUE_TIMEOUT,
+)
+embedding_limiter = RateLimiter(
+    "Embedding",
+    requests_per_minute=EMBEDDING_RPM,
+    tokens_per_minute=EMBEDDING_TPM,
+    max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+    max_retries=GEMINI_MAX_RETRIES,
+    base_delay=GEMINI_RETRY_BASE_DELAY,
+    max_delay=GEMINI_RETRY_MAX_DELAY,
+    queue_timeout=GEMINI_QUEUE_TIMEOUT,
+)
+
+embedding_flights = SingleFlight("embedding")
+retrieval_flights = SingleFlight("retrieval")
+answer_flights = SingleFlight("answer")
+
+
+def _coalesce(flights, key, fn, *args):
+    """Run fn(*args), or wait for an identical call already in flight"""
+    if not COALESCE_REQUESTS:
+        return fn(*args)
+    return flights.do(key, fn, *args)
+
+
+# Answer text shown when Gemini stays overloaded or over quota after retries
+BUSY_MESSAGE = "השירות עמוס כרגע, נסה שוב בעוד מספר שניות"
+
+context_cache = ClientContextCache(
+    genai_client, model_id, ttl_seconds=CONTEXT_CACHE_TTL
+)
+
+# Shared worker pool for overlapping retrieval branches
+_retrieval_pool = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval"
+)
+
+# Worker pool for background work that must not delay the answer
+_background_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
+
+# Bounded pool for the per-chunk extraction calls of map-reduce answering
+_map_pool = ThreadPoolExecutor(
+    max_workers=MAP_REDUCE_MAX_WORKERS, thread_name_prefix="map"
+)
+
+
+_mongo_manager = None
+_mongo_manager_lock = threading.Lock()
+
+
+def get_mongo_manager():
+    """Get the process-wide MongoDB connection manager"""
+    global _mongo_manager
+    if _mongo_manager is None:
+        with _mongo_manager_lock:
+            if _mongo_manager is None:
+                _mongo_manager = MongoConnectionManager(
+                    require_setting("MONGODB_URI"),
+                    max_pool_size=MONGODB_MAX_POOL_SIZE,
+                    min_pool_size=MONGODB_MIN_POOL_SIZE,
+                    server_selection_timeout_ms=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                    connect_timeout_ms=MONGODB_CONNECT_TIMEOUT_MS,
+                    socket_timeout_ms=MONGODB_SOCKET_TIMEOUT_MS,
+                    health_check_interval=MONGODB_HEALTH_CHECK_INTERVAL,
+                )
+    return _mongo_manager
 
 
 def init_mongodb():
-    """Initialize MongoDB connection"""
-    client = MongoClient(MONGODB_URI)
-    return client.conversations_db.conversations
+    """Get the conversations collection from the shared MongoDB client"""
+    return get_mongo_manager().get_collection("conversations_db", "conversations")
+
 
+local_vector_index = LocalVectorIndex(
+    ttl_seconds=LOCAL_VECTOR_TTL, max_clients=LOCAL_INDEX_MAX_CLIENTS
+)
+local_text_index = LocalTextIndex(
+    refresh_interval=LOCAL_TEXT_REFRESH_INTERVAL, max_clients=LOCAL_INDEX_MAX_CLIENTS
+)
 
-def get_embedding(text):
-    """Get text embedding using Gemini API"""
-    result = genaiEmb.embed_content(
-        model="models/text-embedding-004", content=text, task_type="retrieval_query"
+embedding_cache = EmbeddingCache(
+    path=EMBEDDING_CACHE_PATH or None,
+    memory_size=EMBEDDING_CACHE_MEMORY_SIZE,
+    max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+    max_age_seconds=EMBEDDING_CACHE_MAX_AGE_DAYS * 24 * 3600,
+)
+
+
+@traced()
+def get_embedding(text, task_type="retrieval_query"):
+    """Get text embedding using Gemini API, served from the cache when possible"""
+    cached = embedding_cache.get(text, EMBEDDING_MODEL, task_type)
+    tracing.set_attrs(cache="hit" if cached is not None else "miss")
+    if cached is not None:
+        return cached
+    return _coalesce(
+        embedding_flights, (normalize_text(text), task_type), _embed, text, task_type
+    )
+
+
+def _embed(text, task_type):
+    (embedding,) = embedding_limiter.call(
+        get_provider().embed,
+        [text],
+        task_type,
+        EMBEDDING_MODEL,
+        tokens=estimate_tokens(text),
     )
-    return result["embedding"]
+    embedding_cache.set(text, EMBEDDING_MODEL, task_type, embedding)
+    return embedding
+
+
+answer_cache = AnswerCache(
+    ttl_seconds=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES
+)
+
+
+_client_index = None
+_client_index_lock = threading.Lock()
+
+
+def get_client_index():
+    """Get the process-wide clients summary index"""
+    global _client_index
+    if _client_index is None:
+        with _client_index_lock:
+            if _client_index is None:
+                _client_index = ClientIndex(
+                    lambda: get_mongo_manager().get_database("conversations_db"),
+                    ttl_seconds=CLIENT_INDEX_TTL,
+                    refresh_interval=CLIENT_INDEX_REFRESH_INTERVAL,
+                )
+                if CLIENT_INDEX_REFRESH_INTERVAL > 0:
+                    _client_index.start()
+    return _client_index
+
+
+@traced()
+def get_clients_page(search="", page=0, page_size=CLIENT_PAGE_SIZE):
+    """Get one page of client IDs (and the total) from the clients summary"""
+    return get_client_index().get_page(search, page, page_size)
 
 
-def get_all_clients(collection):
+@traced()
+def get_all_clients(collection=None):
     """Get sorted list of all client IDs"""
+    if collection is None:
+        collection = init_mongodb()
     clients = collection.distinct("contact_id")
     return sorted([int(cid) for cid in clients])
 
 
+@traced()
+def vector_search(collection, query_embedding, contact_id, n=100):
+    """Run the $vectorSearch branch for one client"""
+    return list(
+        collection.aggregate(
+            [
+                {
+                    "$vectorSearch": {
+                        "index": "vector_index",
+                        "path": "embedding",
+                        "queryVector": query_embedding,
+                        "numCandidates": 100,
+                        "limit": n,
+                        "filter": {"contact_id": {"$eq": contact_id}},
+                    }
+                },
+                {
+                    "$project": {
+                        **LEAN_PROJECTION,
+                        "search_score": {"$meta": "vectorSearchScore"},
+                        "vector_score": {"$meta": "vectorSearchScore"},
+                        "text_score": {"$literal": 0},
+                    }
+                },
+            ]
+        )
+    )
+
+
+@traced()
+def text_search(collection, query_text, contact_id, n=100, text_weight=0.9):
+    """Run the $search (lexical) branch for one client"""
+    return list(
+        collection.aggregate(
+            [
+                build_text_search_stage(query_text, contact_id, boost=text_weight),
+                {"$limit": n},
+                {
+                    "$project": {
+                        **LEAN_PROJECTION,
+                        "search_score": {"$meta": "searchScore"},
+                        "vector_score": {"$literal": 0},
+                        "text_score": {"$meta": "searchScore"},
+                    }
+                },
+            ]
+        )
+    )
+
+
+@traced()
+def merge_search_results(vector_results, text_results, n=100):
+    """Group results by conversation_id, keep the highest score and take top n"""
+    grouped_results = {}
+    for result in vector_results + text_results:
+        conv_id = result["conversation_id"]
+        if (
+            conv_id not in grouped_results
+            or result["search_score"] > grouped_results[conv_id]["search_score"]
+        ):
+            grouped_results[conv_id] = result
+
+    return sorted(
+        grouped_results.values(), key=lambda x: x["search_score"], reverse=True
+    )[:n]
+
+
+@traced()
+def local_vector_search(collection, query_embedding, contact_id, n=100):
+    """Vector search over the client's embeddings in-process"""
+    return local_vector_index.search(collection, contact_id, query_embedding, n)
+
+
+@traced()
+def local_text_search(collection, query_text, contact_id, n=100, text_weight=0.9):
+    """BM25 search over the client's conversations in-process"""
+    return local_text_index.search(collection, contact_id, query_text, n, text_weight)
+
+
+@traced()
+def use_local_indexes(collection, contact_id, mode=RETRIEVAL_MODE):
+    """Whether both branches should run in-process for this client"""
+    if mode == "local":
+        return True
+    if LOCAL_INDEX_MAX_DOCS <= 0:
+        return False
+    count = collection.count_documents(
+        {"contact_id": contact_id}, limit=LOCAL_INDEX_MAX_DOCS + 1
+    )
+    return count <= LOCAL_INDEX_MAX_DOCS
+
+
+def _vector_hits(collection, query_embedding, contact_id, n, local=False):
+    """Run the vector branch, falling back to the local index
+
+    Returns None if neither $vectorSearch nor the local index could answer.
+    """
+    if not local:
+        try:
+            return vector_search(collection, query_embedding, contact_id, n)
+        except Exception as e:
+            report_error("Vector search", e)
+    try:
+        return local_vector_search(collection, query_embedding, contact_id, n)
+    except Exception as e:
+        report_error("Local vector search", e)
+    return None
+
+
+def _text_hits(collection, query_text, contact_id, n, text_weight, local=False):
+    """Run the text branch, falling back to the local BM25 index
+
+    Returns None if neither $search nor the local index could answer.
+    """
+    if not local:
+        try:
+            return text_search(collection, query_text, contact_id, n, text_weight)
+        except Exception as e:
+            report_error("Text search", e)
+    try:
+        return local_text_search(collection, query_text, contact_id, n, text_weight)
+    except Exception as e:
+        report_error("Local text search", e)
+    return None
+
+
+@traced()
+def rerank_hits(collection, hits, contact_id, k=RERANK_TOP_K, lambda_=RERANK_LAMBDA):
+    """Cut ranked hits to k diverse ones with MMR over their embeddings
+
+    Only the top RERANK_CANDIDATES hits are candidates, and MMR is skipped
+    (the hits are just cut to k) unless there are RERANK_MIN_EXTRA more hits
+    than k. Embeddings come from the local vector index (the client's cached
+    matrix, or one query for just the candidates); if they cannot be loaded
+    the top k hits are kept as ranked.
+    """
+    if not k:
+        return hits
+    if len(hits) < k + RERANK_MIN_EXTRA:
+        return hits[:k]
+    candidates = hits[: max(k, RERANK_CANDIDATES)]
+    try:
+        embeddings = local_vector_index.vectors(
+            collection, contact_id, [hit["conversation_id"] for hit in candidates]
+        )
+        return mmr_rerank(candidates, embeddings, k, lambda_)
+    except Exception as e:
+        report_error("Rerank", e)
+        return hits[:k]
+
+
+@traced()
+def basic_find(collection, contact_id, n=100):
+    """Fallback to the client's most recent conversations, unranked"""
+    return [
+        {**doc, "search_score": 0, "vector_score": 0, "text_score": 0}
+        for doc in collection.find({"contact_id": contact_id}, LEAN_PROJECTION)
+        .sort("start_time", -1)
+        .limit(n)
+    ]
+
+
+@traced()
+def hydrate_conversations(collection, hits, contact_id=None):
+    """Fetch full conversations for ranked hits in one batched $in query
+
+    Hits only carry ids, timestamps and scores; the returned documents keep
+    the hits' order and scores and never include the embedding. Compressed
+    messages are only decompressed when first read.
+    """
+    if not hits:
+        return []
+
+    query = {"conversation_id": {"$in": [hit["conversation_id"] for hit in hits]}}
+    if contact_id is not None:
+        query["contact_id"] = contact_id
+    docs = {
+        doc["conversation_id"]: inflate(doc)
+        for doc in collection.find(query, HYDRATE_PROJECTION)
+    }
+
+    hydrated = []
+    for hit in hits:
+        doc = docs.get(hit["conversation_id"])
+        if doc is not None:
+            hydrated.append({**doc, **hit})
+    if tracing.active():
+        tracing.set_attrs(
+            message_bytes=sum(
+                payload_bytes(doc.get("messages", [])) for doc in hydrated
+            )
+        )
+    return hydrated
+
+
+@traced()
+def hybrid_search(
+    collection,
+    query_embedding,
+    query_text,
+    contact_id,
+    n=100,
+    vector_weight=0.1,
+    text_weight=0.9,
+    min_text_score=0.7,
+    fusion=RETRIEVAL_FUSION,
+):
+    """Run vector and text search with server-side score fusion in one round trip"""
+    pipeline = build_hybrid_pipeline(
+        collection.name,
+        query_embedding,
+        query_text,
+        contact_id,
+        n=n,
+        vector_weight=vector_weight,
+        text_weight=text_weight,
+        min_text_score=min_text_score,
+        fusion=fusion,
+    )
+    return list(collection.aggregate(pipeline))
+
+
+@traced()
 def find_similar_conversations(
     collection,
     query_embedding,
@@ -56,105 +559,278 @@ def find_similar_conversations(
     vector_weight=0.1,
     text_weight=0.9,
     min_text_score=0.7,
+    mode="merge",
+    hydrate=True,
+    rerank_k=RERANK_TOP_K,
+    rerank_lambda=RERANK_LAMBDA,
 ):
-    """Find similar conversations using weighted combination of vector and text search"""
+    """Find similar conversations using weighted combination of vector and text search
+
+    The n ranked hits are cut to rerank_k diverse ones with MMR (see
+    rerank_hits) before hydration. Identical concurrent calls share one
+    search.
+    """
+    if collection is None:
+        collection = init_mongodb()
     contact_id = int(contact_id)
+    params = (
+        n,
+        vector_weight,
+        text_weight,
+        min_text_score,
+        mode,
+        hydrate,
+        rerank_k,
+        rerank_lambda,
+    )
+    key = (
+        "find_similar",
+        collection.name,
+        contact_id,
+        normalize_text(query_text),
+        hashlib.sha256(array("d", query_embedding).tobytes()).hexdigest(),
+        params,
+    )
+    return _coalesce(
+        retrieval_flights,
+        key,
+        _find_similar,
+        collection,
+        query_embedding,
+        query_text,
+        contact_id,
+        *params,
+    )
 
-    try:
-        # First try vector search only to see if it works
-        vector_results = list(
-            collection.aggregate(
-                [
-                    {
-                        "$vectorSearch": {
-                            "index": "vector_index",
-                            "path": "embedding",
-                            "queryVector": query_embedding,
-                            "numCandidates": 100,
-                            "limit": n,
-                            "filter": {"contact_id": {"$eq": contact_id}},
-                        }
-                    },
-                    {
-                        "$addFields": {
-                            "search_score": {"$meta": "vectorSearchScore"},
-                            "vector_score": {"$meta": "vectorSearchScore"},
-                            "text_score": {"$literal": 0},
-                        }
-                    },
-                ]
-            )
-        )
 
-        # If vector search worked, try to enhance with text search
+def _find_similar(
+    collection,
+    query_embedding,
+    query_text,
+    contact_id,
+    n,
+    vector_weight,
+    text_weight,
+    min_text_score,
+    mode,
+    hydrate,
+    rerank_k,
+    rerank_lambda,
+):
+    hits = _find_similar_hits(
+        collection,
+        query_embedding,
+        query_text,
+        contact_id,
+        n,
+        vector_weight,
+        text_weight,
+        min_text_score,
+        mode,
+    )
+    hits = rerank_hits(collection, hits, contact_id, rerank_k, rerank_lambda)
+    return hydrate_conversations(collection, hits, contact_id) if hydrate else hits
+
+
+def _find_similar_hits(
+    collection,
+    query_embedding,
+    query_text,
+    contact_id,
+    n,
+    vector_weight,
+    text_weight,
+    min_text_score,
+    mode,
+):
+    """Rank conversations on ids and scores only (first retrieval phase)"""
+    local = use_local_indexes(collection, contact_id, mode)
+    if mode == "hybrid" and not local:
         try:
-            text_results = list(
-                collection.aggregate(
-                    [
-                        {
-                            "$search": {
-                                "index": "text_index",
-                                "text": {
-                                    "query": query_text,
-                                    "path": {"wildcard": "*"},
-                                    "score": {"boost": {"value": text_weight}},
-                                },
-                            }
-                        },
-                        {"$match": {"contact_id": contact_id}},
-                        {
-                            "$addFields": {
-                                "search_score": {"$meta": "searchScore"},
-                                "vector_score": {"$literal": 0},
-                                "text_score": {"$meta": "searchScore"},
-                            }
-                        },
-                        {"$limit": n},
-                    ]
-                )
+            return hybrid_search(
+                collection,
+                query_embedding,
+                query_text,
+                contact_id,
+                n,
+                vector_weight,
+                text_weight,
+                min_text_score,
             )
+        except Exception as e:
+            report_error("Hybrid search", e)
 
-            # Combine results
-            all_results = vector_results + text_results
+    vector_results = _vector_hits(collection, query_embedding, contact_id, n, local)
+    text_results = _text_hits(collection, query_text, contact_id, n, text_weight, local)
+    if vector_results is None and text_results is None:
+        return basic_find(collection, contact_id, n)
+    return merge_search_results(vector_results or [], text_results or [], n)
 
-            # Group by conversation_id and take the highest score
-            grouped_results = {}
-            for result in all_results:
-                conv_id = result["conversation_id"]
-                if (
-                    conv_id not in grouped_results
-                    or result["search_score"] > grouped_results[conv_id]["search_score"]
-                ):
-                    grouped_results[conv_id] = result
 
-            # Sort by combined score and take top n
-            final_results = sorted(
-                grouped_results.values(), key=lambda x: x["search_score"], reverse=True
-            )[:n]
+def _embed_and_vector_search(collection, query_text, contact_id, n, local=False):
+    """Embed the question and run the vector branch (runs in the retrieval pool)"""
+    query_embedding = get_embedding(query_text)
+    return _vector_hits(collection, query_embedding, contact_id, n, local)
 
-            return final_results
-
-        except Exception as text_error:
-            print(f"Text search error: {text_error}")
-            return vector_results
 
+def _branch_result(future, deadline, branch_name):
+    """Wait for a retrieval branch until the deadline, returning None on failure"""
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        report_error(f"{branch_name} search", TimeoutError("deadline exceeded"))
     except Exception as e:
-        print(f"Vector search error: {e}")
+        report_error(f"{branch_name} search", e)
+    return None
 
-        # Fallback to basic find with contact_id filter
-        return list(
-            collection.find(
-                {"contact_id": contact_id},
-                {
-                    "conversation_id": 1,
-                    "contact_id": 1,
-                    "start_time": 1,
-                    "end_time": 1,
-                    "messages": 1,
-                    "text_for_embedding": 1,
-                },
-            ).limit(n)
-        )
+
+@traced()
+def retrieve_conversations(
+    collection,
+    query_text,
+    contact_id,
+    n=100,
+    vector_weight=0.1,
+    text_weight=0.9,
+    min_text_score=0.7,
+    vector_timeout=RETRIEVAL_VECTOR_TIMEOUT,
+    text_timeout=RETRIEVAL_TEXT_TIMEOUT,
+    mode=RETRIEVAL_MODE,
+    hydrate=True,
+    rerank_k=RERANK_TOP_K,
+    rerank_lambda=RERANK_LAMBDA,
+):
+    """Run embedding + vector search and text search concurrently and merge them
+
+    The text branch starts immediately since it does not need the embedding.
+    Each branch has its own deadline; a slow or failing branch degrades to the
+    other branch's results instead of stalling the answer.
+
+    In "hybrid" mode the question is embedded first and both branches are
+    fused server-side in a single aggregation; the concurrent branches are
+    only used if that aggregation fails. In "local" mode (or for clients
+    small enough for LOCAL_INDEX_MAX_DOCS) both branches are served by the
+    in-process indexes, which also back up a failing $vectorSearch/$search.
+
+    Ranking only moves ids and scores; the top n are cut to rerank_k diverse
+    ones with MMR and hydrated with one batched query unless hydrate is False.
+    Identical concurrent calls share one retrieval.
+    """
+    if collection is None:
+        collection = init_mongodb()
+    contact_id = int(contact_id)
+    params = (
+        n,
+        vector_weight,
+        text_weight,
+        min_text_score,
+        vector_timeout,
+        text_timeout,
+        mode,
+        hydrate,
+        rerank_k,
+        rerank_lambda,
+    )
+    key = (
+        "retrieve",
+        collection.name,
+        contact_id,
+        normalize_text(query_text),
+        params,
+    )
+    return _coalesce(
+        retrieval_flights, key, _retrieve, collection, query_text, contact_id, *params
+    )
+
+
+def _retrieve(
+    collection,
+    query_text,
+    contact_id,
+    n,
+    vector_weight,
+    text_weight,
+    min_text_score,
+    vector_timeout,
+    text_timeout,
+    mode,
+    hydrate,
+    rerank_k,
+    rerank_lambda,
+):
+    hits = _retrieve_hits(
+        collection,
+        query_text,
+        contact_id,
+        n,
+        vector_weight,
+        text_weight,
+        min_text_score,
+        vector_timeout,
+        text_timeout,
+        mode,
+    )
+    hits = rerank_hits(collection, hits, contact_id, rerank_k, rerank_lambda)
+    return hydrate_conversations(collection, hits, contact_id) if hydrate else hits
+
+
+def _retrieve_hits(
+    collection,
+    query_text,
+    contact_id,
+    n,
+    vector_weight,
+    text_weight,
+    min_text_score,
+    vector_timeout,
+    text_timeout,
+    mode,
+):
+    """Rank conversations concurrently on ids and scores only"""
+    local = use_local_indexes(collection, contact_id, mode)
+    if mode == "hybrid" and not local:
+        try:
+            query_embedding = get_embedding(query_text)
+            return hybrid_search(
+                collection,
+                query_embedding,
+                query_text,
+                contact_id,
+                n,
+                vector_weight,
+                text_weight,
+                min_text_score,
+            )
+        except Exception as e:
+            report_error("Hybrid search", e)
+
+    started = time.monotonic()
+    text_future = tracing.submit(
+        _retrieval_pool,
+        _text_hits,
+        collection,
+        query_text,
+        contact_id,
+        n,
+        text_weight,
+        local,
+    )
+    vector_future = tracing.submit(
+        _retrieval_pool,
+        _embed_and_vector_search,
+        collection,
+        query_text,
+        contact_id,
+        n,
+        local,
+    )
+
+    vector_results = _branch_result(vector_future, started + vector_timeout, "Vector")
+    text_results = _branch_result(text_future, started + text_timeout, "Text")
+
+    if vector_results is None and text_results is None:
+        return basic_find(collection, contact_id, n)
+    return merge_search_results(vector_results or [], text_results or [], n)
 
 
 # def find_similar_conversations(collection, query_embedding, contact_id, n=10):
@@ -188,6 +864,7 @@ def find_similar_conversations(
 #     return list(results)
 
 
+@traced()
 def format_context(conversations):
     """Format conversations for context"""
     formatted_context = []
@@ -216,43 +893,517 @@ def format_context(conversations):
     return formatted_context
 
 
-def get_gemini_response(question, context, conversation_history=[]):
-    """Get response from Gemini model with conversation history"""
-    # Format conversation history
-    history_text = ""
-    if conversation_history:
-        history_text = "Previous conversation:\n"
-        for msg in conversation_history:
-            role = "User" if msg["role"] == "user" else "Assistant"
-            history_text += f"{role}: {msg['content']}\n"
-        history_text += "\n"
+@traced()
+def load_client_corpus(collection, contact_id):
+    """Serialize a client's whole archive for context caching"""
+    if collection is None:
+        collection = init_mongodb()
+    conversations = (
+        inflate(doc)
+        for doc in collection.find({"contact_id": int(contact_id)}, HYDRATE_PROJECTION)
+    )
+    return build_corpus(conversations, token_budget=CONTEXT_CACHE_MAX_TOKENS)
+
+
+@traced()
+def get_client_context_cache(contact_id, data_version, collection=None):
+    """Get (creating once) the cached archive for a client, or None"""
+    if not CONTEXT_CACHE_ENABLED or contact_id is None:
+        return None
+    entry = context_cache.get_or_create(
+        contact_id, data_version, lambda: load_client_corpus(collection, contact_id)
+    )
+    tracing.set_attrs(cached=entry is not None)
+    return entry
+
+
+def new_history_summary():
+    """Empty rolling summary state for a chat session"""
+    return {"text": "", "covered": 0, "pending": False, "lock": threading.Lock()}
+
+
+@traced()
+def format_history(
+    conversation_history, history_summary=None, token_cap=HISTORY_TOKEN_CAP
+):
+    """Format chat history for the prompt within a token cap
+
+    Messages already folded into the rolling summary are replaced by the
+    summary; the remaining messages are kept verbatim, dropping the oldest
+    ones if they do not fit in token_cap.
+    """
+    summary_text = ""
+    covered = 0
+    if history_summary is not None:
+        summary_text = history_summary["text"]
+        covered = history_summary["covered"]
 
+    lines = []
+    for msg in conversation_history[covered:]:
+        role = "User" if msg["role"] == "user" else "Assistant"
+        lines.append(f"{role}: {msg['content']}\n")
+
+    used_tokens = estimate_tokens(summary_text)
+    kept = []
+    for line in reversed(lines):
+        line_tokens = estimate_tokens(line)
+        if kept and used_tokens + line_tokens > token_cap:
+            break
+        kept.append(line)
+        used_tokens += line_tokens
+    kept.reverse()
+
+    if not summary_text and not kept:
+        return ""
+    history_text = "Previous conversation:\n"
+    if summary_text:
+        history_text += f"Summary of earlier conversation: {summary_text}\n"
+    return history_text + "".join(kept) + "\n"
+
+
+def _summarize_history(history_summary, messages, covered):
+    """Fold messages into the rolling summary (runs in the background pool)"""
+    transcript = "".join(
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}\n"
+        for msg in messages
+    )
     prompt = f"""
-בהתבסס על ארכיון השיחות עם הלקוח שלנו ב-'fair: קרנות נאמנות אונליין'
-{json.dumps(context, indent=2, ensure_ascii=False)}
+עדכן את הסיכום של שיחת הניתוח בין האנליסט לעוזר.
+סיכום קיים:
+{history_summary["text"] or "(אין)"}
 
-{history_text if conversation_history else ""}
-Current question: {question}
+הודעות חדשות לשילוב בסיכום:
+{transcript}
 
-ענה על השאלה תוך שימוש במידע מהשיחות. בסוף כל טענה או מידע, הוסף מספר בסוגריים מרובעות שמציין את מספר השיחה הרלוונטית, לדוגמה:
-"הלקוח ביקש עזרה בהעברת כספים [1]"
+החזר סיכום תמציתי אחד (עד {HISTORY_SUMMARY_TOKENS} טוקנים) של השאלות שנשאלו,
+הממצאים העיקריים והקשר שנדרש לשאלות המשך.
+"""
+    from google.genai.types import GenerateContentConfig
+
+    try:
+        response = generation_limiter.call(
+            genai_client().models.generate_content,
+            model=model_id,
+            contents=prompt,
+            config=GenerateContentConfig(
+                response_modalities=["TEXT"],
+                max_output_tokens=HISTORY_SUMMARY_TOKENS,
+            ),
+            tokens=estimate_tokens(prompt),
+        )
+        with history_summary["lock"]:
+            history_summary["text"] = (response.text or "").strip()
+            history_summary["covered"] = covered
+    except Exception as e:
+        report_error("History summary", e)
+    finally:
+        history_summary["pending"] = False
+
+
+@traced()
+def update_history_summary(
+    history_summary, conversation_history, recent_messages=HISTORY_RECENT_MESSAGES
+):
+    """Summarize messages older than the verbatim window in the background
+
+    Returns the background future, or None when there is nothing to fold in
+    or an update is already running.
+    """
+    covered = len(conversation_history) - recent_messages
+    with history_summary["lock"]:
+        if covered <= history_summary["covered"] or history_summary["pending"]:
+            return None
+        history_summary["pending"] = True
+        messages = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in conversation_history[history_summary["covered"] : covered]
+        ]
+    return _background_pool.submit(
+        _summarize_history, history_summary, messages, covered
+    )
 
+
+def _sources_instructions(structured):
+    if structured:
+        return """
+החזר JSON עם השדות:
+answer - התשובה, כולל מספרי השיחות בסוגריים מרובעים
+citations - רשימת מספרי השיחות (i) שצוטטו בתשובה
+"""
+    return """
 בסוף התשובה, הוסף רשימת מקורות מפורטת בפורמט הבא:
 מקורות:
 [1] שיחה מתאריך YYYY-MM-DD: תיאור קצר של תוכן השיחה
 [2] שיחה מתאריך YYYY-MM-DD: תיאור קצר של תוכן השיחה
+"""
+
+
+@traced()
+def build_prompt(
+    question,
+    context,
+    conversation_history=[],
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    structured=STRUCTURED_CITATIONS,
+    history_summary=None,
+    cached_conversation_ids=None,
+):
+    """Build the answer prompt, returning it with the context packing report
+
+    With cached_conversation_ids (the client's archive is in Gemini cached
+    content), retrieved conversations that are in the cache are referenced
+    by id only and just the missing ones are packed into the prompt.
+    """
+    packed = pack_context(
+        context,
+        question,
+        token_budget=token_budget,
+        max_messages=CONTEXT_MAX_MESSAGES,
+        skip_ids=cached_conversation_ids,
+    )
+    tracing.set_attrs(
+        context_tokens=packed["tokens"],
+        included=len(packed["included"]),
+        dropped=len(packed["dropped"]),
+    )
+
+    # Format conversation history (summary of older turns + recent turns)
+    history_text = format_history(conversation_history, history_summary)
+
+    sources_instructions = _sources_instructions(structured)
+
+    context_text = f"{CONTEXT_LEGEND}\n{packed['text']}"
+    if cached_conversation_ids is not None:
+        retrieved_ids = ", ".join(
+            f"{index}={conv['conversation_id']}"
+            for index, conv in enumerate(context, start=1)
+            if conv["conversation_id"] in cached_conversation_ids
+        )
+        context_text = (
+            "ארכיון השיחות המלא של הלקוח נמצא בתוכן השמור.\n"
+            f"השיחות הרלוונטיות לשאלה (מספר השיחה i=מזהה שיחה id): {retrieved_ids}\n"
+            f"{context_text}"
+        )
+
+    prompt = f"""
+בהתבסס על ארכיון השיחות עם הלקוח שלנו ב-'fair: קרנות נאמנות אונליין'
+{context_text}
 
+{history_text}
+Current question: {question}
+
+ענה על השאלה תוך שימוש במידע מהשיחות. בסוף כל טענה או מידע, הוסף מספר בסוגריים מרובעות שמציין את מספר השיחה הרלוונטית (i), לדוגמה:
+"הלקוח ביקש עזרה בהעברת כספים [1]"
+{sources_instructions}
 אם הקונטקסט לא מכיל מידע רלוונטי - תאמר זאת.
 """
+    if tracing.active():
+        tracing.set_attrs(
+            prompt_tokens=estimate_tokens(prompt),
+            prompt_bytes=len(prompt.encode("utf-8")),
+        )
+    return prompt, packed
+
+
+def _extract_chunk(question, start, conversations, history_text):
+    """Extract the notes relevant to the question from one chunk of context
+
+    Runs in the map pool. Notes cite conversations by their number in the
+    whole context.
+    """
+    with tracing.span("map_chunk", start=start, conversations=len(conversations)):
+        packed = pack_context(
+            conversations,
+            question,
+            token_budget=MAP_REDUCE_CHUNK_TOKENS,
+            max_messages=CONTEXT_MAX_MESSAGES,
+            start=start,
+        )
+        prompt = f"""
+להלן חלק מארכיון השיחות עם הלקוח שלנו ב-'fair: קרנות נאמנות אונליין'
+{CONTEXT_LEGEND}
+{packed["text"]}
+
+{history_text}
+Current question: {question}
+
+אל תענה על השאלה. חלץ מהשיחות האלה את כל המידע הרלוונטי לשאלה כרשימת נקודות תמציתית.
+בסוף כל נקודה, הוסף מספר בסוגריים מרובעות שמציין את מספר השיחה הרלוונטית (i), לדוגמה:
+"הלקוח ביקש עזרה בהעברת כספים [{start}]"
+{_sources_instructions(True)}
+אם אין בשיחות מידע רלוונטי - החזר answer ריק.
+"""
+        response = generation_limiter.call(
+            genai_client().models.generate_content,
+            model=model_id,
+            contents=prompt,
+            config=_generation_config(structured=True),
+            tokens=estimate_tokens(prompt),
+        )
+        response_text = response.text or ""
+        tracing.set_attrs(**_usage_attrs(response, response_text))
+        notes, citations = parse_answer(response_text)
+        return {
+            "start": start,
+            "end": start + len(conversations) - 1,
+            "notes": notes.strip(),
+            "citations": citations,
+            "packed": packed,
+        }
+
+
+@traced()
+def map_context(question, chunks, history_text="", timeout=MAP_REDUCE_TIMEOUT):
+    """Run the extraction calls for all chunks concurrently in the map pool
+
+    Returns one partial result per chunk that finished in time, in context
+    order; failed chunks are reported and left out.
+    """
+    deadline = time.monotonic() + timeout
+    futures = [
+        tracing.submit(
+            _map_pool, _extract_chunk, question, start, conversations, history_text
+        )
+        for start, conversations, _ in chunks
+    ]
+    partials = []
+    for future, (start, conversations, _) in zip(futures, chunks):
+        try:
+            partials.append(
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+            )
+        except FuturesTimeoutError:
+            future.cancel()
+            report_error(f"Map chunk {start}", TimeoutError("deadline exceeded"))
+        except Exception as e:
+            report_error(f"Map chunk {start}", e)
+    tracing.set_attrs(chunks=len(chunks), failed=len(chunks) - len(partials))
+    return partials
+
+
+def build_reduce_prompt(
+    question, partials, history_text="", structured=STRUCTURED_CITATIONS
+):
+    """Prompt merging the per-chunk notes into one answer"""
+    notes_text = "\n\n".join(
+        f"ממצאים משיחות {partial['start']}-{partial['end']}:\n{partial['notes']}"
+        for partial in partials
+        if partial["notes"]
+    )
+    prompt = f"""
+ארכיון השיחות עם הלקוח שלנו ב-'fair: קרנות נאמנות אונליין' חולק לחלקים, ומכל חלק חולץ המידע הרלוונטי לשאלה.
+המספרים בסוגריים מרובעים הם מספרי השיחות (i) בארכיון.
+{notes_text or "(לא נמצא מידע רלוונטי)"}
+
+{history_text}
+Current question: {question}
+
+ענה על השאלה תוך שימוש בממצאים. מזג ממצאים חופפים ושמור על מספרי השיחות בדיוק כפי שהם מופיעים בממצאים, בסוף כל טענה או מידע, לדוגמה:
+"הלקוח ביקש עזרה בהעברת כספים [1]"
+{_sources_instructions(structured)}
+אם הממצאים לא מכילים מידע רלוונטי - תאמר זאת.
+"""
+    if tracing.active():
+        tracing.set_attrs(
+            prompt_tokens=estimate_tokens(prompt),
+            prompt_bytes=len(prompt.encode("utf-8")),
+        )
+    return prompt
+
+
+@traced()
+def build_map_reduce_prompt(
+    question,
+    context,
+    conversation_history=[],
+    history_summary=None,
+    chunks=None,
+):
+    """Extract notes from chunks of context concurrently and build the reduce prompt
+
+    Returns the reduce prompt and a context report in the shape of
+    pack_context()'s, covering all chunks, with the number of chunks added.
+    Chunks past MAP_REDUCE_MAX_CHUNKS (the least relevant conversations) and
+    chunks whose extraction failed count as dropped.
+    """
+    if chunks is None:
+        chunks = chunk_context(
+            context, question, MAP_REDUCE_CHUNK_TOKENS, CONTEXT_MAX_MESSAGES
+        )
+    history_text = format_history(conversation_history, history_summary)
+    partials = map_context(question, chunks[:MAP_REDUCE_MAX_CHUNKS], history_text)
+
+    report = {"tokens": 0, "included": [], "truncated": [], "dropped": []}
+    extracted = set()
+    for partial in partials:
+        extracted.add(partial["start"])
+        for key in ("included", "truncated", "dropped"):
+            report[key].extend(partial["packed"][key])
+        report["tokens"] += partial["packed"]["tokens"]
+    for start, conversations, _ in chunks:
+        if start not in extracted:
+            report["dropped"].extend(conv["conversation_id"] for conv in conversations)
+    report["chunks"] = len(chunks)
+
+    report["text"] = "\n\n".join(partial["notes"] for partial in partials)
+    return build_reduce_prompt(question, partials, history_text), report
+
+
+def _answer_prompt(
+    question,
+    context,
+    conversation_history,
+    token_budget,
+    history_summary,
+    contact_id,
+    data_version,
+):
+    """Prompt, context report and generation config for answering a question
+
+    Context that does not fit token_budget is answered by map-reduce when
+    MAP_REDUCE_ENABLED, unless the client's archive is in Gemini cached
+    content (which already covers it).
+    """
+    cache_entry = get_client_context_cache(contact_id, data_version)
+    if MAP_REDUCE_ENABLED and cache_entry is None:
+        chunks = chunk_context(
+            context, question, MAP_REDUCE_CHUNK_TOKENS, CONTEXT_MAX_MESSAGES
+        )
+        if len(chunks) > 1 and sum(tokens for *_, tokens in chunks) > token_budget:
+            prompt, packed = build_map_reduce_prompt(
+                question, context, conversation_history, history_summary, chunks
+            )
+            return prompt, packed, _generation_config()
+
+    prompt, packed = build_prompt(
+        question,
+        context,
+        conversation_history,
+        token_budget,
+        history_summary=history_summary,
+        cached_conversation_ids=(
+            cache_entry["conversation_ids"] if cache_entry else None
+        ),
+    )
+    config = _generation_config(
+        cached_content=cache_entry["name"] if cache_entry else None
+    )
+    return prompt, packed, config
+
+
+def _generation_config(structured=STRUCTURED_CITATIONS, cached_content=None):
+    """Generation config, requesting schema-constrained JSON when structured"""
+    from google.genai.types import GenerateContentConfig
+
+    if structured:
+        return GenerateContentConfig(
+            response_modalities=["TEXT"],
+            response_mime_type="application/json",
+            response_schema=ANSWER_SCHEMA,
+            cached_content=cached_content,
+        )
+    return GenerateContentConfig(
+        # tools=[Tool(google_search=GoogleSearch())],
+        response_modalities=["TEXT"],
+        cached_content=cached_content,
+    )
+
+
+def _error_text(error):
+    """Answer text for a failed generation"""
+    if isinstance(error, RateLimitTimeout) or is_retryable(error):
+        return BUSY_MESSAGE
+    return f"Error generating response: {error}"
+
+
+def _usage_attrs(response, response_text):
+    """Gemini's token counts for a response (or an estimate)"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "candidates_token_count", None):
+        return {
+            "prompt_token_count": usage.prompt_token_count,
+            "cached_token_count": getattr(usage, "cached_content_token_count", None),
+            "response_tokens": usage.candidates_token_count,
+        }
+    return {"response_tokens": estimate_tokens(response_text)}
+
+
+@traced()
+def get_gemini_response(
+    question,
+    context,
+    conversation_history=[],
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    history_summary=None,
+    contact_id=None,
+    data_version=None,
+):
+    """Get response from Gemini model with conversation history
+
+    Returns the answer text, the cited conversation numbers (1-based positions
+    in context) and the context packing report. Identical concurrent requests
+    (same question, context and history) share one generation.
+    """
+    args = (
+        question,
+        context,
+        conversation_history,
+        token_budget,
+        history_summary,
+        contact_id,
+        data_version,
+    )
+    return _coalesce(answer_flights, _answer_key("response", *args), _respond, *args)
+
+
+def _answer_key(
+    kind,
+    question,
+    context,
+    conversation_history,
+    token_budget,
+    history_summary,
+    contact_id,
+    data_version,
+):
+    """Identity of an answer request: what ends up in the prompt"""
+    return (
+        kind,
+        contact_id,
+        data_version,
+        normalize_text(question),
+        make_context_fingerprint(context),
+        history_fingerprint(conversation_history, history_summary),
+        token_budget,
+    )
+
+
+def _respond(
+    question,
+    context,
+    conversation_history,
+    token_budget,
+    history_summary,
+    contact_id,
+    data_version,
+):
+    prompt, packed, config = _answer_prompt(
+        question,
+        context,
+        conversation_history,
+        token_budget,
+        history_summary,
+        contact_id,
+        data_version,
+    )
 
     try:
-        response = client.models.generate_content(
+        response = generation_limiter.call(
+            genai_client().models.generate_content,
             model=model_id,
             contents=prompt,
-            config=GenerateContentConfig(
-                # tools=[google_search_tool],
-                response_modalities=["TEXT"],
-            ),
+            config=config,
+            tokens=estimate_tokens(prompt),
         )
 
         # Safely extract search entry point if it exists
@@ -283,8 +1434,291 @@ Current question: {question}
         else:
             response_text = str(response)
 
-        return {"text": response_text, "search_entry_point": search_entry_point}
+        tracing.set_attrs(**_usage_attrs(response, response_text))
+        answer, citations = parse_answer(response_text)
+        return {
+            "text": answer,
+            "citations": citations,
+            "search_entry_point": search_entry_point,
+            "context_report": packed,
+        }
 
     except Exception as e:
-        print(f"Error generating response: {e}")
-        return {"text": f"Error generating response: {e}", "search_entry_point": None}
+        report_error("Generation", e)
+        return {
+            "text": _error_text(e),
+            "citations": [],
+            "search_entry_point": None,
+            "context_report": packed,
+        }
+
+
+@traced()
+def get_gemini_response_stream(
+    question,
+    context,
+    conversation_history=[],
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    history_summary=None,
+    contact_id=None,
+    data_version=None,
+):
+    """Stream response text chunks from Gemini as they are generated
+
+    Returns a dict with a "stream" generator of answer text chunks (suitable
+    for st.write_stream). Once the stream is exhausted, "text", "citations"
+    and the "context_report" from packing the prompt are filled in.
+
+    The prompt is built when the stream starts. If an identical request
+    (same question, context and history) is already streaming, this one
+    waits for it and yields its answer in one chunk instead of generating
+    again; it falls back to generating if that stream fails to finish.
+    """
+    args = (
+        question,
+        context,
+        conversation_history,
+        token_budget,
+        history_summary,
+        contact_id,
+        data_version,
+    )
+    result = {"context_report": None, "text": "", "citations": []}
+
+    def stream():
+        # The flight is joined on the first chunk, so a stream that is never
+        # consumed never leaves followers waiting
+        leader = False
+        if COALESCE_REQUESTS:
+            key = _answer_key("stream", *args)
+            future, leader = answer_flights.begin(key)
+            if not leader:
+                shared = _shared_answer(future)
+                if shared is not None:
+                    result.update(shared)
+                    yield result["text"]
+                    return
+
+        completed = False
+        try:
+            yield from _stream_answer(result, *args)
+            completed = True
+        finally:
+            if leader and completed:
+                answer_flights.finish(
+                    key,
+                    future,
+                    {
+                        "text": result["text"],
+                        "citations": result["citations"],
+                        "context_report": result["context_report"],
+                    },
+                )
+            elif leader:
+                answer_flights.finish(
+                    key, future, error=RuntimeError("answer stream was not finished")
+                )
+
+    result["stream"] = stream()
+    return result
+
+
+def _shared_answer(future):
+    """The answer of the identical stream being followed, or None on failure"""
+    try:
+        return future.result(timeout=COALESCE_ANSWER_TIMEOUT)
+    except FuturesTimeoutError:
+        report_error("Coalesced answer", TimeoutError("leader did not finish"))
+    except Exception as e:
+        report_error("Coalesced answer", e)
+    return None
+
+
+def _stream_answer(
+    result,
+    question,
+    context,
+    conversation_history,
+    token_budget,
+    history_summary,
+    contact_id,
+    data_version,
+):
+    """Build the prompt and stream the answer, filling in result"""
+    prompt, packed, config = _answer_prompt(
+        question,
+        context,
+        conversation_history,
+        token_budget,
+        history_summary,
+        contact_id,
+        data_version,
+    )
+    result["context_report"] = packed
+
+    decoder = AnswerStreamDecoder() if STRUCTURED_CITATIONS else None
+    raw_text = ""
+    # Timed by hand: a span context would stay open across the yields
+    started = time.perf_counter()
+    attrs = {}
+    last_chunk = None
+    attempt = 0
+    while True:
+        try:
+            # The slot is held until the stream ends, so streams count
+            # against the concurrency cap like any other call
+            with generation_limiter.slot(estimate_tokens(prompt)) as waited:
+                attrs["queue_wait_ms"] = round(waited * 1000, 3)
+                for chunk in genai_client().models.generate_content_stream(
+                    model=model_id,
+                    contents=prompt,
+                    config=config,
+                ):
+                    last_chunk = chunk
+                    if not chunk.text:
+                        continue
+                    if not raw_text:
+                        attrs["first_chunk_ms"] = round(
+                            (time.perf_counter() - started) * 1000, 3
+                        )
+                    raw_text += chunk.text
+                    text = decoder.feed(chunk.text) if decoder else chunk.text
+                    if text:
+                        yield text
+            break
+        except Exception as e:
+            # Only retry before anything was shown to the user
+            delay = None if raw_text else generation_limiter.retry_delay(e, attempt)
+            if delay is not None:
+                attempt += 1
+                attrs["retries"] = attempt
+                time.sleep(delay)
+                continue
+            report_error("Streaming generation", e)
+            tracing.record_span("generate_stream", started, error=str(e), **attrs)
+            result["text"] = _error_text(e)
+            yield result["text"]
+            return
+
+    attrs.update(_usage_attrs(last_chunk, raw_text))
+    tracing.record_span("generate_stream", started, **attrs)
+    result["text"], result["citations"] = parse_answer(raw_text)
+
+
+@traced()
+def get_client_data_version(collection, contact_id):
+    """Cheap version stamp of a client's conversations (count and last activity)"""
+    if collection is None:
+        collection = init_mongodb()
+    result = list(
+        collection.aggregate(
+            [
+                {"$match": {"contact_id": int(contact_id)}},
+                {
+                    "$group": {
+                        "_id": None,
+                        "count": {"$sum": 1},
+                        "last_activity": {"$max": "$end_time"},
+                    }
+                },
+            ]
+        )
+    )
+    if not result:
+        return (0, None)
+    return (result[0]["count"], result[0]["last_activity"])
+
+
+def history_fingerprint(conversation_history, history_summary=None):
+    """Hash the chat history as it goes into the prompt ("" for no history)"""
+    history_text = format_history(conversation_history, history_summary)
+    if not history_text:
+        return ""
+    return hashlib.sha256(history_text.encode("utf-8")).hexdigest()
+
+
+@traced()
+def get_cached_answer(
+    contact_id, question, conversations, data_version=None, history=""
+):
+    """Look up a cached answer for this question, retrieved context and history
+
+    history is the history_fingerprint() of the turns before the question.
+    """
+    answer = answer_cache.get(
+        contact_id,
+        question,
+        model_id,
+        make_context_fingerprint(conversations),
+        history=history,
+        data_version=data_version,
+    )
+    tracing.set_attrs(cache="hit" if answer else "miss")
+    return answer
+
+
+@traced()
+def get_semantic_cached_answer(contact_id, question, data_version=None, history=""):
+    """Reuse an answer to a near-duplicate question (only in semantic mode)
+
+    A follow-up question (non-empty history) depends on the turns before it
+    and on fresh retrieval, so it is never answered from this lookup.
+    """
+    if not ANSWER_CACHE_SEMANTIC or history:
+        return None
+    answer = answer_cache.get_similar(
+        contact_id,
+        model_id,
+        get_embedding(question),
+        threshold=ANSWER_CACHE_SEMANTIC_THRESHOLD,
+        data_version=data_version,
+    )
+    tracing.set_attrs(cache="hit" if answer else "miss")
+    return answer
+
+
+@traced()
+def cache_answer(
+    contact_id, question, conversations, answer, data_version=None, history=""
+):
+    """Store a generated answer for later exact or semantic reuse"""
+    if answer["text"].startswith("Error generating response") or (
+        answer["text"] == BUSY_MESSAGE
+    ):
+        return
+    answer_cache.set(
+        contact_id,
+        question,
+        model_id,
+        make_context_fingerprint(conversations),
+        answer,
+        question_embedding=get_embedding(question) if ANSWER_CACHE_SEMANTIC else None,
+        history=history,
+        data_version=data_version,
+    )
+
+
+def get_rate_limit_stats():
+    """Admission, queue-wait and retry counters of the Gemini rate limiters"""
+    return {
+        limiter.name: limiter.get_stats()
+        for limiter in (generation_limiter, embedding_limiter)
+    }
+
+
+def get_single_flight_stats():
+    """Leader/follower counts of the request coalescing layers"""
+    return {
+        flights.name: flights.get_stats()
+        for flights in (embedding_flights, retrieval_flights, answer_flights)
+    }
+
+
+def start_request_trace(name, profile=False, log=True, **attrs):
+    """Trace one request (a page run or a question)
+
+    With log=True the trace is appended to TRACE_LOG_PATH when it finishes.
+    """
+    return tracing.start_trace(
+        name, log=trace_log if log else None, profile=profile, **attrs
+    )
@@ -0,0 +1,206 @@
+"""Single-round-trip hybrid (vector + text) search pipelines for Atlas"""
+
+FUSION_METHODS = ("rrf", "minmax")
+
+# Fields mapped for full-text search in text_index (see search_indexes.py):
+# plain documents' messages, compressed documents' search_text
+TEXT_SEARCH_PATHS = ["messages.content", "search_text"]
+
+# First retrieval phase: rank on ids, timestamps and scores only
+LEAN_PROJECTION = {
+    "_id": 0,
+    "conversation_id": 1,
+    "contact_id": 1,
+    "start_time": 1,
+    "end_time": 1,
+}
+
+# Second phase: hydrate only the conversations that are actually used
+# (messages in either the plain or the compressed format, see message_store)
+HYDRATE_PROJECTION = {
+    "_id": 0,
+    "conversation_id": 1,
+    "contact_id": 1,
+    "start_time": 1,
+    "end_time": 1,
+    "messages": 1,
+    "messages_blob": 1,
+    "messages_codec": 1,
+    "message_count": 1,
+}
+
+
+def build_text_search_stage(
+    query_text, contact_id, text_index="text_index", boost=None
+):
+    """$search stage scoped to one client inside the search engine
+
+    contact_id is applied as a compound filter so only that client's
+    documents are matched and scored, instead of matching the whole corpus and
+    discarding other clients afterwards. Filters do not affect the score.
+    """
+    text = {"query": query_text, "path": TEXT_SEARCH_PATHS}
+    if boost is not None:
+        text["score"] = {"boost": {"value": boost}}
+    return {
+        "$search": {
+            "index": text_index,
+            "compound": {
+                "must": [{"text": text}],
+                "filter": [{"equals": {"path": "contact_id", "value": contact_id}}],
+            },
+        }
+    }
+
+
+def _rank_branch(score_field, rank_field, weight, fusion, rrf_k):
+    """Stages that turn one branch's ordered hits into weighted fused scores
+
+    The branch's hits are gathered into a single array so that each document
+    can see its rank (for reciprocal-rank fusion) or the branch's min/max
+    score (for min-max normalization).
+    """
+    stages = [
+        {
+            "$group": {
+                "_id": None,
+                "docs": {"$push": "$$ROOT"},
+                "max_score": {"$max": f"${score_field}"},
+                "min_score": {"$min": f"${score_field}"},
+            }
+        },
+        {"$unwind": {"path": "$docs", "includeArrayIndex": rank_field}},
+    ]
+
+    if fusion == "rrf":
+        weighted = {
+            "$multiply": [
+                weight,
+                {"$divide": [1.0, {"$add": [f"${rank_field}", rrf_k + 1]}]},
+            ]
+        }
+    else:
+        # Min-max normalize into 0..1; a branch with a single distinct score
+        # counts as a perfect match
+        score_range = {"$subtract": ["$max_score", "$min_score"]}
+        weighted = {
+            "$multiply": [
+                weight,
+                {
+                    "$cond": [
+                        {"$gt": [score_range, 0]},
+                        {
+                            "$divide": [
+                                {"$subtract": [f"$docs.{score_field}", "$min_score"]},
+                                score_range,
+                            ]
+                        },
+                        1.0,
+                    ]
+                },
+            ]
+        }
+
+    stages.append(
+        {
+            "$replaceRoot": {
+                "newRoot": {
+                    "$mergeObjects": [
+                        "$docs",
+                        {f"{score_field}_fused": weighted},
+                    ]
+                }
+            }
+        }
+    )
+    return stages
+
+
+def build_hybrid_pipeline(
+    collection_name,
+    query_embedding,
+    query_text,
+    contact_id,
+    n=100,
+    vector_weight=0.1,
+    text_weight=0.9,
+    min_text_score=0.7,
+    fusion="rrf",
+    num_candidates=100,
+    rrf_k=60,
+    vector_index="vector_index",
+    text_index="text_index",
+):
+    """Build one aggregation that runs both searches, fuses scores and returns top n
+
+    Vector hits come from $vectorSearch; text hits are pulled in with
+    $unionWith over the same collection. Scores are fused with either
+    reciprocal-rank fusion ("rrf") or min-max normalized weighted sums
+    ("minmax"), so the incomparable vectorSearchScore and BM25 searchScore are
+    never compared directly. Text hits scoring below min_text_score are dropped
+    before fusion. Only LEAN_PROJECTION fields and scores are returned.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {fusion}")
+
+    vector_branch = [
+        {
+            "$vectorSearch": {
+                "index": vector_index,
+                "path": "embedding",
+                "queryVector": query_embedding,
+                "numCandidates": max(num_candidates, n),
+                "limit": n,
+                "filter": {"contact_id": {"$eq": contact_id}},
+            }
+        },
+        {
+            "$project": {
+                **LEAN_PROJECTION,
+                "vector_score": {"$meta": "vectorSearchScore"},
+            }
+        },
+    ] + _rank_branch("vector_score", "vector_rank", vector_weight, fusion, rrf_k)
+
+    text_branch = [
+        build_text_search_stage(query_text, contact_id, text_index),
+        {"$project": {**LEAN_PROJECTION, "text_score": {"$meta": "searchScore"}}},
+        {"$match": {"text_score": {"$gte": min_text_score}}},
+        {"$limit": n},
+    ] + _rank_branch("text_score", "text_rank", text_weight, fusion, rrf_k)
+
+    return vector_branch + [
+        {"$unionWith": {"coll": collection_name, "pipeline": text_branch}},
+        {
+            "$group": {
+                "_id": "$conversation_id",
+                "doc": {"$first": "$$ROOT"},
+                "vector_score": {"$max": "$vector_score"},
+                "text_score": {"$max": "$text_score"},
+                "vector_fused": {"$max": "$vector_score_fused"},
+                "text_fused": {"$max": "$text_score_fused"},
+            }
+        },
+        {
+            "$replaceRoot": {
+                "newRoot": {
+                    "$mergeObjects": [
+                        "$doc",
+                        {
+                            "vector_score": {"$ifNull": ["$vector_score", 0]},
+                            "text_score": {"$ifNull": ["$text_score", 0]},
+                            "search_score": {
+                                "$add": [
+                                    {"$ifNull": ["$vector_fused", 0]},
+                                    {"$ifNull": ["$text_fused", 0]},
+                                ]
+                            },
+                        },
+                    ]
+                }
+            }
+        },
+        {"$project": {"vector_score_fused": 0, "text_score_fused": 0}},
+        {"$sort": {"search_score": -1}},
+        {"$limit": n},
+    ]
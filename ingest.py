@@ -0,0 +1,222 @@
+"""Batch ingestion: embed conversations and upsert them into MongoDB
+
+Reads conversations from a JSONL file or a source collection, builds
+text_for_embedding, embeds in batches with task_type="retrieval_document",
+and writes with unordered bulk upserts. Progress is checkpointed after each
+batch so an interrupted run can resume, and documents whose text hash has not
+changed are not re-embedded. With --compress the messages are written in the
+compressed format (see message_store.py) instead of as plain arrays.
+
+Usage:
+    python ingest.py --jsonl conversations.jsonl
+    python ingest.py --source-collection raw_conversations --batch-size 100
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from bson import json_util
+from pymongo import MongoClient, UpdateOne
+
+from client_index import ClientIndex
+from message_store import (
+    COMPRESSED_FIELDS,
+    DEFAULT_CODEC,
+    build_text_for_embedding,
+    compress_messages,
+)
+from providers import EMBEDDING_MODEL, GeminiProvider, get_provider, set_provider
+
+CONVERSATION_FIELDS = (
+    "conversation_id",
+    "contact_id",
+    "start_time",
+    "end_time",
+    "messages",
+)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_jsonl(path, start=0):
+    """Yield (position, conversation) from a JSONL file, skipping `start` lines"""
+    with open(path, encoding="utf-8") as f:
+        for position, line in enumerate(f, start=1):
+            if position <= start or not line.strip():
+                continue
+            yield position, json.loads(line)
+
+
+def read_collection(collection, start=None):
+    """Yield (position, conversation) from a collection in _id order"""
+    query = {"_id": {"$gt": start}} if start is not None else {}
+    for doc in collection.find(query).sort("_id", 1):
+        yield doc["_id"], doc
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json_util.loads(f.read())
+    return {}
+
+
+def save_checkpoint(path, checkpoint):
+    """Atomically write the checkpoint file"""
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json_util.dumps(checkpoint))
+    os.replace(tmp_path, path)
+
+
+def embed_batch(texts, retries=3):
+    """Embed a batch of documents in one API call, retrying on failure"""
+    for attempt in range(retries):
+        try:
+            return get_provider().embed(texts, "retrieval_document", EMBEDDING_MODEL)
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            print(f"Embedding error (attempt {attempt + 1}): {e}")
+            time.sleep(2**attempt)
+
+
+def ingest_batch(target, batch, force=False, codec=None):
+    """Embed changed conversations in a batch and upsert the whole batch
+
+    With a codec, messages are stored compressed and text_for_embedding is
+    not stored at all.
+
+    Returns (written, embedded) counts.
+    """
+    docs = []
+    for _, conversation in batch:
+        doc = {field: conversation[field] for field in CONVERSATION_FIELDS}
+        doc["contact_id"] = int(doc["contact_id"])
+        doc["text_for_embedding"] = build_text_for_embedding(doc["messages"])
+        doc["text_hash"] = text_hash(doc["text_for_embedding"])
+        docs.append(doc)
+
+    # Only re-embed documents whose text changed since they were last written
+    existing = {}
+    if not force:
+        existing = {
+            doc["conversation_id"]: doc.get("text_hash")
+            for doc in target.find(
+                {
+                    "conversation_id": {"$in": [d["conversation_id"] for d in docs]},
+                    "embedding": {"$exists": True},
+                },
+                {"_id": 0, "conversation_id": 1, "text_hash": 1},
+            )
+        }
+    to_embed = [d for d in docs if existing.get(d["conversation_id"]) != d["text_hash"]]
+    if to_embed:
+        embeddings = embed_batch([d["text_for_embedding"] for d in to_embed])
+        for doc, embedding in zip(to_embed, embeddings):
+            doc["embedding"] = embedding
+
+    operations = []
+    for doc in docs:
+        # updated_at drives the incremental refresh of the clients summary
+        update = {"$set": doc, "$currentDate": {"updated_at": True}}
+        if codec:
+            messages = doc.pop("messages")
+            del doc["text_for_embedding"]
+            doc.update(compress_messages(messages, codec))
+            update["$unset"] = {"messages": "", "text_for_embedding": ""}
+        else:
+            update["$unset"] = {field: "" for field in COMPRESSED_FIELDS}
+        operations.append(
+            UpdateOne({"conversation_id": doc["conversation_id"]}, update, upsert=True)
+        )
+    target.bulk_write(operations, ordered=False)
+    return len(docs), len(to_embed)
+
+
+def run(args):
+    set_provider(GeminiProvider(api_key=args.api_key))
+    mongo = MongoClient(args.uri)
+    db = mongo[args.db]
+    target = db[args.collection]
+    target.create_index("conversation_id", unique=True)
+
+    checkpoint = load_checkpoint(args.checkpoint)
+    source_name = args.jsonl or args.source_collection
+    if checkpoint.get("source") != source_name:
+        checkpoint = {"source": source_name, "position": None}
+
+    if args.jsonl:
+        items = read_jsonl(args.jsonl, checkpoint["position"] or 0)
+    else:
+        items = read_collection(db[args.source_collection], checkpoint["position"])
+
+    total_written = total_embedded = 0
+    for batch in batched(items, args.batch_size):
+        written, embedded = ingest_batch(
+            target, batch, force=args.force, codec=args.codec if args.compress else None
+        )
+        total_written += written
+        total_embedded += embedded
+        checkpoint["position"] = batch[-1][0]
+        save_checkpoint(args.checkpoint, checkpoint)
+        print(f"Wrote {total_written} conversations ({total_embedded} embedded)")
+
+    if args.refresh_clients:
+        ClientIndex(lambda: db, target.name).refresh()
+        print("Refreshed clients summary")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--jsonl", help="JSONL file with one conversation per line")
+    source.add_argument("--source-collection", help="collection to read from")
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"))
+    parser.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"))
+    parser.add_argument("--db", default="conversations_db")
+    parser.add_argument("--collection", default="conversations")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--checkpoint", default=".cache/ingest_checkpoint.json")
+    parser.add_argument(
+        "--force", action="store_true", help="re-embed even if the text is unchanged"
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="store messages as a compressed blob (see message_store.py)",
+    )
+    parser.add_argument("--codec", choices=("zstd", "zlib"), default=DEFAULT_CODEC)
+    parser.add_argument(
+        "--refresh-clients",
+        action="store_true",
+        help="refresh the clients summary collection afterwards",
+    )
+    args = parser.parse_args()
+    if not args.uri or not args.api_key:
+        parser.error("MONGODB_URI and GEMINI_API_KEY must be set (or passed)")
+    if args.checkpoint:
+        os.makedirs(os.path.dirname(args.checkpoint) or ".", exist_ok=True)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""In-process BM25 lexical search over a client's conversations"""
+
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+
+from hybrid_search import LEAN_PROJECTION
+
+# Hebrew points and cantillation marks (niqqud), except maqaf which joins words
+_NIQQUD_RE = re.compile(r"[\u0591-\u05bd\u05bf-\u05c7]")
+_WORD_RE = re.compile(r"\w+")
+_HEBREW_RE = re.compile(r"^[\u05d0-\u05ea]+$")
+
+# One-letter prefixes (and, the, in, to, that) that attach to Hebrew words
+HEBREW_PREFIXES = "והבלש"
+MAX_PREFIXES = 2
+MIN_STEM_LENGTH = 3
+
+
+def normalize_text(text):
+    """Drop niqqud, quote marks inside acronyms, and case"""
+    text = _NIQQUD_RE.sub("", text)
+    text = text.replace("\u05be", " ")
+    text = re.sub(r"(?<=\w)[\"'\u05f3\u05f4](?=\w)", "", text)
+    return text.lower()
+
+
+def tokenize(text):
+    """Split text into normalized words"""
+    return _WORD_RE.findall(normalize_text(text))
+
+
+def term_variants(token):
+    """The word itself plus its forms with up to MAX_PREFIXES prefixes stripped
+
+    Whether a leading letter is a prefix cannot be told from the word alone
+    (ל in "לקוח" is not one), so every candidate form is indexed and queried.
+    """
+    variants = [token]
+    if not _HEBREW_RE.match(token):
+        return variants
+    for _ in range(MAX_PREFIXES):
+        if token[0] not in HEBREW_PREFIXES or len(token) <= MIN_STEM_LENGTH:
+            break
+        token = token[1:]
+        variants.append(token)
+    return variants
+
+
+def conversation_text(doc):
+    """Searchable text of a conversation: its messages' contents"""
+    if "search_text" in doc:
+        return doc["search_text"]
+    if doc.get("messages"):
+        return "\n".join(
+            msg["content"] for msg in doc["messages"] if not msg.get("quick_replies")
+        )
+    return doc.get("text_for_embedding", "")
+
+
+class BM25Index:
+    """Inverted index with BM25 scoring over one client's conversations
+
+    Documents are keyed by conversation_id; adding a conversation that is
+    already indexed replaces its postings. Every word is posted under all its
+    prefix variants, and each query word scores with its best matching
+    variant so a word is never counted more than once.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.docs = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def remove(self, conversation_id):
+        doc = self.docs.pop(conversation_id, None)
+        if doc is None:
+            return
+        self.total_length -= doc["length"]
+        for term in doc["terms"]:
+            postings = self.postings[term]
+            del postings[conversation_id]
+            if not postings:
+                del self.postings[term]
+
+    def add(self, hit, text):
+        """Index a conversation; hit holds the lean fields returned by search"""
+        conversation_id = hit["conversation_id"]
+        self.remove(conversation_id)
+        tokens = tokenize(text)
+        counts = Counter(
+            variant for token in tokens for variant in set(term_variants(token))
+        )
+        length = len(tokens)
+        self.docs[conversation_id] = {
+            "hit": hit,
+            "length": length,
+            "terms": list(counts),
+        }
+        self.total_length += length
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[conversation_id] = tf
+
+    def search(self, query_text, n=100):
+        """Return the top n (hit, score) pairs for a query"""
+        if not self.docs:
+            return []
+        doc_count = len(self.docs)
+        avg_length = self.total_length / doc_count or 1.0
+        scores = {}
+        for token in set(tokenize(query_text)):
+            best = {}
+            for term in term_variants(token):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for conversation_id, tf in postings.items():
+                    length = self.docs[conversation_id]["length"]
+                    norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                    score = idf * tf * (self.k1 + 1) / (tf + norm)
+                    if score > best.get(conversation_id, 0.0):
+                        best[conversation_id] = score
+            for conversation_id, score in best.items():
+                scores[conversation_id] = scores.get(conversation_id, 0.0) + score
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [(self.docs[cid]["hit"], score) for cid, score in ranked]
+
+
+class LocalTextIndex:
+    """Per-client BM25 indexes cached in memory and updated incrementally
+
+    A client's index is built on first use, then at most once per
+    refresh_interval updated with the conversations written since the newest
+    updated_at already indexed (which ingest sets on every write), so
+    backfilled and re-ingested conversations are picked up too, and cleared
+    of conversations that no longer exist. The least recently used clients
+    are evicted beyond max_clients.
+    """
+
+    # Writes that commit out of updated_at order are caught by re-reading
+    # this far behind the watermark; re-adding a conversation replaces it
+    WATERMARK_OVERLAP = timedelta(minutes=5)
+
+    def __init__(self, refresh_interval=60, max_clients=32):
+        self.refresh_interval = refresh_interval
+        self.max_clients = max_clients
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _update(self, collection, contact_id, entry):
+        """Index the client's conversations written since the watermark"""
+        index = entry["index"]
+        query = {"contact_id": contact_id}
+        if entry["watermark"] is not None:
+            query["updated_at"] = {"$gte": entry["watermark"] - self.WATERMARK_OVERLAP}
+        elif entry["refreshed_at"] is not None:
+            query["updated_at"] = {"$exists": True}
+        # Compressed documents are read through search_text, never decompressed
+        projection = {
+            **LEAN_PROJECTION,
+            "messages": 1,
+            "search_text": 1,
+            "text_for_embedding": 1,
+            "updated_at": 1,
+        }
+        for doc in collection.find(query, projection):
+            text = conversation_text(doc)
+            hit = {field: doc[field] for field in LEAN_PROJECTION if field in doc}
+            index.add(hit, text)
+            updated_at = doc.get("updated_at")
+            if updated_at is not None and (
+                entry["watermark"] is None or updated_at > entry["watermark"]
+            ):
+                entry["watermark"] = updated_at
+
+        # Deletions leave nothing to fetch, so compare against the stored ids
+        if entry["refreshed_at"] is not None:
+            existing = set(
+                collection.distinct("conversation_id", {"contact_id": contact_id})
+            )
+            for conversation_id in [cid for cid in index.docs if cid not in existing]:
+                index.remove(conversation_id)
+        entry["refreshed_at"] = time.monotonic()
+
+    def _entry(self, collection, contact_id):
+        """Return the client's entry, building or refreshing its index if due"""
+        key = (collection.name, contact_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {
+                    "index": BM25Index(),
+                    "watermark": None,
+                    "refreshed_at": None,
+                    "lock": threading.Lock(),
+                }
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_clients:
+                self._entries.popitem(last=False)
+
+        with entry["lock"]:
+            if (
+                entry["refreshed_at"] is None
+                or time.monotonic() - entry["refreshed_at"] >= self.refresh_interval
+            ):
+                self._update(collection, contact_id, entry)
+        return entry
+
+    def get(self, collection, contact_id):
+        """Return the client's BM25 index, building or refreshing it if due"""
+        return self._entry(collection, contact_id)["index"]
+
+    def search(self, collection, contact_id, query_text, n=100, text_weight=1.0):
+        """Return the top n lean hits scored like the $search branch"""
+        entry = self._entry(collection, contact_id)
+        with entry["lock"]:
+            ranked = entry["index"].search(query_text, n)
+        return [
+            {
+                **hit,
+                "search_score": score * text_weight,
+                "vector_score": 0,
+                "text_score": score * text_weight,
+            }
+            for hit, score in ranked
+        ]
@@ -0,0 +1,227 @@
+"""Compressed storage of conversation transcripts
+
+In the compressed format a conversation's messages are stored as a zstd (or
+zlib) compressed JSON blob in messages_blob, instead of as a plain messages
+array plus a text_for_embedding copy. A small uncompressed header
+(message_count, message_roles and, when messages carry them,
+message_timestamps) stays queryable, and search_text keeps the message
+contents uncompressed for Atlas $search and the local BM25 index, so the
+saving is the messages array and text_for_embedding, not all of the text.
+Readers wrap the blob in LazyMessages, which only decompresses when the
+messages are actually read.
+
+Run as a script to migrate existing documents:
+    python message_store.py                 # compress plain documents (and add
+                                            # search_text to compressed ones)
+    python message_store.py --codec zlib    # without zstandard installed
+    python message_store.py --decompress    # convert back to plain documents
+"""
+
+import argparse
+import json
+import os
+import zlib
+from collections.abc import Sequence
+
+from bson import Binary
+from pymongo import MongoClient, UpdateOne
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is always available
+    zstandard = None
+
+# Fields to project when reading messages in either format
+MESSAGE_FIELDS = ("messages", "messages_blob", "messages_codec", "message_count")
+HEADER_FIELDS = ("message_count", "message_roles", "message_timestamps")
+COMPRESSED_FIELDS = ("messages_blob", "messages_codec", "search_text") + HEADER_FIELDS
+DEFAULT_CODEC = "zstd" if zstandard else "zlib"
+
+
+def _compress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, 9)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def _decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd-compressed messages need the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec: {codec}")
+
+
+def build_text_for_embedding(messages):
+    """Flatten messages into the text that gets embedded"""
+    return "\n".join(
+        f"{msg['role']}: {msg['content']}"
+        for msg in messages
+        if not msg.get("quick_replies")
+    )
+
+
+def build_search_text(messages):
+    """The message contents that are searched, kept uncompressed"""
+    return "\n".join(msg["content"] for msg in messages if not msg.get("quick_replies"))
+
+
+def compress_messages(messages, codec=DEFAULT_CODEC):
+    """Document fields holding messages in the compressed format"""
+    data = json.dumps(messages, ensure_ascii=False, separators=(",", ":"))
+    fields = {
+        "messages_blob": Binary(_compress(data.encode("utf-8"), codec)),
+        "messages_codec": codec,
+        "message_count": len(messages),
+        "message_roles": [msg["role"] for msg in messages],
+        "search_text": build_search_text(messages),
+    }
+    if any("timestamp" in msg for msg in messages):
+        fields["message_timestamps"] = [msg.get("timestamp") for msg in messages]
+    return fields
+
+
+def decompress_messages(blob, codec):
+    return json.loads(_decompress(bytes(blob), codec).decode("utf-8"))
+
+
+class LazyMessages(Sequence):
+    """A conversation's messages, decompressed on first read
+
+    len() and the header fields are available without decompressing.
+    """
+
+    def __init__(self, blob, codec, count=None):
+        self.blob = blob
+        self.codec = codec
+        self.count = count
+        self._messages = None
+
+    @property
+    def loaded(self):
+        return self._messages is not None
+
+    @property
+    def nbytes(self):
+        """Size of the compressed blob"""
+        return len(self.blob)
+
+    def _load(self):
+        if self._messages is None:
+            self._messages = decompress_messages(self.blob, self.codec)
+        return self._messages
+
+    def __len__(self):
+        if self._messages is None and self.count is not None:
+            return self.count
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __iter__(self):
+        return iter(self._load())
+
+
+def inflate(doc):
+    """Give a fetched document a lazy messages field if it is compressed
+
+    Works in place and returns the document; plain documents are returned
+    unchanged.
+    """
+    blob = doc.pop("messages_blob", None)
+    if blob is not None:
+        doc["messages"] = LazyMessages(
+            blob, doc.pop("messages_codec", "zlib"), doc.get("message_count")
+        )
+    return doc
+
+
+def payload_bytes(messages):
+    """Bytes a conversation's messages took on the wire"""
+    if isinstance(messages, LazyMessages):
+        return messages.nbytes
+    return sum(len(msg["content"].encode("utf-8")) for msg in messages)
+
+
+def migrate(collection, codec=DEFAULT_CODEC, batch_size=500, decompress=False):
+    """Convert documents to (or, with decompress, from) the compressed format
+
+    Only documents still in the other format are touched, so an interrupted
+    run can simply be started again. Compressing also adds search_text to
+    compressed documents written without it; decompressing restores
+    text_for_embedding. Returns the number of documents changed.
+    """
+    if decompress:
+        query = {"messages_blob": {"$exists": True}}
+        projection = {"_id": 1, "messages_blob": 1, "messages_codec": 1}
+    else:
+        query = {
+            "$or": [
+                {"messages": {"$exists": True}, "messages_blob": {"$exists": False}},
+                {"messages_blob": {"$exists": True}, "search_text": {"$exists": False}},
+            ]
+        }
+        projection = {"_id": 1, "messages": 1, "messages_blob": 1, "messages_codec": 1}
+
+    changed = 0
+    operations = []
+    for doc in collection.find(query, projection):
+        if decompress:
+            messages = decompress_messages(doc["messages_blob"], doc["messages_codec"])
+            update = {
+                "$set": {
+                    "messages": messages,
+                    "text_for_embedding": build_text_for_embedding(messages),
+                },
+                "$unset": {field: "" for field in COMPRESSED_FIELDS},
+            }
+        elif "messages_blob" in doc:
+            messages = decompress_messages(doc["messages_blob"], doc["messages_codec"])
+            update = {"$set": {"search_text": build_search_text(messages)}}
+        else:
+            update = {
+                "$set": compress_messages(doc["messages"], codec),
+                "$unset": {"messages": "", "text_for_embedding": ""},
+            }
+        operations.append(UpdateOne({"_id": doc["_id"]}, update))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            changed += len(operations)
+            operations = []
+            print(f"Migrated {changed} conversations")
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        changed += len(operations)
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"))
+    parser.add_argument("--db", default="conversations_db")
+    parser.add_argument("--collection", default="conversations")
+    parser.add_argument("--codec", choices=("zstd", "zlib"), default=DEFAULT_CODEC)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--decompress",
+        action="store_true",
+        help="convert compressed documents back to plain messages",
+    )
+    args = parser.parse_args()
+    if not args.uri:
+        parser.error("MONGODB_URI must be set (or passed)")
+
+    collection = MongoClient(args.uri)[args.db][args.collection]
+    changed = migrate(collection, args.codec, args.batch_size, args.decompress)
+    print(f"Done: {changed} conversations converted")
+
+
+if __name__ == "__main__":
+    main()
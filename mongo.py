@@ -0,0 +1,79 @@
+import threading
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import tracing
+
+
+class MongoConnectionManager:
+    """Process-wide pooled MongoDB client
+
+    Reconnects are left to pymongo: its server monitors re-check the
+    deployment every health_check_interval seconds and the pool replaces
+    broken connections, so the shared client is never closed behind the back
+    of threads still using it.
+    """
+
+    def __init__(
+        self,
+        uri,
+        max_pool_size=50,
+        min_pool_size=0,
+        server_selection_timeout_ms=5000,
+        connect_timeout_ms=5000,
+        socket_timeout_ms=30000,
+        max_idle_time_ms=300000,
+        health_check_interval=30,
+    ):
+        self.uri = uri
+        self.client_options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "connectTimeoutMS": connect_timeout_ms,
+            "socketTimeoutMS": socket_timeout_ms,
+            "maxIdleTimeMS": max_idle_time_ms,
+            "heartbeatFrequencyMS": int(health_check_interval * 1000),
+            "retryReads": True,
+            "retryWrites": True,
+        }
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Create a new pooled client (caller must hold the lock)"""
+        self._client = MongoClient(self.uri, **self.client_options)
+
+    def _close(self):
+        """Close the current client (caller must hold the lock)"""
+        if self._client is not None:
+            try:
+                self._client.close()
+            except PyMongoError as e:
+                tracing.report_error("MongoDB close", e)
+        self._client = None
+
+    def get_client(self):
+        """Return the shared client, creating it on first use"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                self._connect()
+            return self._client
+
+    def get_database(self, db_name="conversations_db"):
+        """Return a database handle backed by the shared client"""
+        return self.get_client()[db_name]
+
+    def get_collection(
+        self, db_name="conversations_db", collection_name="conversations"
+    ):
+        """Return a collection handle backed by the shared client"""
+        return self.get_client()[db_name][collection_name]
+
+    def close(self):
+        """Close the shared client"""
+        with self._lock:
+            self._close()
@@ -0,0 +1,89 @@
+"""Settings and the Gemini provider, resolved lazily on first use
+
+Nothing here talks to Gemini or reads secrets at import time. Settings come
+from the environment, then Streamlit secrets (when running under Streamlit
+with a secrets file); the provider can also be replaced outright with
+set_provider(), e.g. by batch jobs or the benchmark.
+"""
+
+import os
+import threading
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_setting(name, default=None):
+    """Read a setting from the environment, falling back to st.secrets"""
+    value = os.getenv(name)
+    if value is not None:
+        return value
+    try:
+        import streamlit as st
+
+        return st.secrets[name]
+    except (ImportError, FileNotFoundError, KeyError):
+        return default
+
+
+def require_setting(name):
+    value = get_setting(name)
+    if value is None:
+        raise RuntimeError(f"{name} must be set in the environment or st.secrets")
+    return value
+
+
+class GeminiProvider:
+    """Generation and embeddings through the google.genai SDK
+
+    The SDK is imported and the client created on first use. client is a
+    genai.Client (or anything with the same models and caches attributes).
+    """
+
+    def __init__(self, api_key=None, client=None):
+        self.api_key = api_key
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google import genai
+
+                    self._client = genai.Client(
+                        api_key=self.api_key or require_setting("GEMINI_API_KEY")
+                    )
+        return self._client
+
+    def embed(self, texts, task_type="retrieval_query", model=EMBEDDING_MODEL):
+        """Embed a list of texts in one call, returning one vector per text"""
+        from google.genai.types import EmbedContentConfig
+
+        response = self.client.models.embed_content(
+            model=model,
+            contents=texts,
+            config=EmbedContentConfig(task_type=task_type.upper()),
+        )
+        return [embedding.values for embedding in response.embeddings]
+
+
+def get_provider():
+    """Get the process-wide provider, creating the default one on first use"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = GeminiProvider()
+    return _provider
+
+
+def set_provider(provider):
+    """Replace the process-wide provider (returns the previous one)"""
+    global _provider
+    with _provider_lock:
+        previous, _provider = _provider, provider
+    return previous
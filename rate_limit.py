@@ -0,0 +1,216 @@
+"""Process-wide rate limiting, concurrency capping and retries for API calls
+
+A RateLimiter admits a call once its request and token buckets hold enough
+budget and a concurrency slot is free, then retries retryable failures (429,
+5xx, timeouts) with jittered exponential backoff. Time spent waiting for
+admission is recorded per call on the current trace span and in the
+limiter's stats.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+import tracing
+
+# HTTP status codes worth retrying: rate limited, or a transient server error
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RateLimitTimeout(TimeoutError):
+    """Raised when a call could not be admitted within the queue timeout"""
+
+
+def is_retryable(error):
+    """Whether an API error is transient (quota, overload or network)"""
+    if isinstance(error, RateLimitTimeout):
+        return False
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    """Refills at per_minute units a minute, holding at most burst_seconds' worth
+
+    A request larger than the bucket is clamped to its capacity, so it waits
+    for a full bucket instead of forever.
+    """
+
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def reserve(self, amount, now):
+        """Take amount from the bucket, returning seconds until it is covered
+
+        The level may go negative; later callers then wait behind this one,
+        which keeps admission first come, first served.
+        """
+        self._refill(now)
+        self._level -= min(amount, self.capacity)
+        return max(0.0, -self._level / self.rate)
+
+    def refund(self, amount):
+        self._level += min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Shared admission control for one API (e.g. generation or embeddings)
+
+    requests_per_minute and tokens_per_minute of 0 disable that bucket;
+    max_concurrency caps calls in flight from this process.
+    """
+
+    def __init__(
+        self,
+        name,
+        requests_per_minute=0,
+        tokens_per_minute=0,
+        max_concurrency=8,
+        max_retries=3,
+        base_delay=1.0,
+        max_delay=20.0,
+        queue_timeout=30.0,
+    ):
+        self.name = name
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "queued": 0,
+            "retries": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "in_flight": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def _refund(self, tokens):
+        """Return a reservation that was not used (caller must hold the lock)"""
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(tokens)
+        self.stats["timeouts"] += 1
+
+    def _admit(self, tokens):
+        """Wait for bucket budget, then a slot; returns the wait in seconds
+
+        The budget is waited for before taking a slot, so calls sleeping off
+        the rate limit do not keep others from calls that are already due.
+        """
+        started = time.monotonic()
+        with self._lock:
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, started))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, started))
+            if delay > self.queue_timeout:
+                self._refund(tokens)
+                raise RateLimitTimeout(f"{self.name}: over quota for {delay:.1f}s")
+        if delay:
+            time.sleep(delay)
+
+        remaining = self.queue_timeout - (time.monotonic() - started)
+        if not self._slots.acquire(timeout=max(0.0, remaining)):
+            with self._lock:
+                self._refund(tokens)
+            raise RateLimitTimeout(f"{self.name}: no free slot")
+
+        waited = time.monotonic() - started
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["in_flight"] += 1
+            if waited > 0.001:
+                self.stats["queued"] += 1
+            self.stats["wait_ms_total"] += waited * 1000
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], waited * 1000)
+        return waited
+
+    @contextmanager
+    def slot(self, tokens=1):
+        """Hold a concurrency slot, admitted by the rate buckets, for the block
+
+        Yields the seconds spent waiting for admission.
+        """
+        waited = self._admit(tokens)
+        tracing.set_attrs(queue_wait_ms=round(waited * 1000, 3))
+        try:
+            yield waited
+        finally:
+            with self._lock:
+                self.stats["in_flight"] -= 1
+            self._slots.release()
+
+    def retry_delay(self, error, attempt):
+        """Backoff before retrying after error, or None to give up
+
+        Full jitter: a random delay up to base_delay * 2**attempt, capped at
+        max_delay, so clients hitting the same limit do not retry in lockstep.
+        """
+        if attempt >= self.max_retries or not is_retryable(error):
+            with self._lock:
+                self.stats["failures"] += 1
+            return None
+        with self._lock:
+            self.stats["retries"] += 1
+        tracing.set_attrs(retries=attempt + 1)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, fn, *args, tokens=1, **kwargs):
+        """Run fn under the limiter, retrying retryable errors
+
+        Each attempt is admitted separately, so retries count against the
+        quota and do not hold a slot while backing off. The last retried error
+        and the total backoff are recorded on the current trace span.
+        """
+        attempt = 0
+        backoff = 0.0
+        while True:
+            try:
+                with self.slot(tokens):
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                backoff += delay
+                tracing.set_attrs(
+                    retry_error=f"{type(e).__name__}: {e}",
+                    backoff_ms=round(backoff * 1000, 3),
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["wait_ms_avg"] = (
+            stats["wait_ms_total"] / stats["calls"] if stats["calls"] else 0.0
+        )
+        return stats
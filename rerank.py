@@ -0,0 +1,58 @@
+"""Maximal marginal relevance reranking of retrieved conversations"""
+
+import numpy as np
+
+from vector_index import normalize_rows
+
+
+def normalize_scores(scores):
+    """Min-max scale scores into 0..1 (all ones if they are all equal)"""
+    scores = np.asarray(scores, dtype=np.float32)
+    if not len(scores):
+        return scores
+    score_range = scores.max() - scores.min()
+    if score_range <= 0:
+        return np.ones_like(scores)
+    return (scores - scores.min()) / score_range
+
+
+def mmr_select(embeddings, relevance, k, lambda_=0.7):
+    """Pick k indices trading relevance against similarity to earlier picks
+
+    Each step takes the candidate maximizing
+    lambda_ * relevance - (1 - lambda_) * max cosine similarity to the
+    conversations already picked, so lambda_=1 keeps the plain ranking and
+    lower values favour diversity. Similarities to the selection are kept as
+    a running maximum, one matrix-vector product per pick. Rows of zeros
+    (conversations without an embedding) are never considered redundant.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, len(relevance))
+    if k <= 0:
+        return []
+
+    vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    selected = []
+    for _ in range(k):
+        scores = lambda_ * relevance - (1 - lambda_) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, vectors @ vectors[best], out=max_similarity)
+    return selected
+
+
+def mmr_rerank(hits, embeddings, k, lambda_=0.7):
+    """Reorder and cut ranked hits to k diverse ones
+
+    Relevance is each hit's search_score scaled to 0..1, so text and vector
+    matches keep the weight retrieval gave them; embeddings has one row per
+    hit.
+    """
+    if len(hits) <= k:
+        return hits
+    relevance = normalize_scores([hit["search_score"] for hit in hits])
+    return [hits[i] for i in mmr_select(embeddings, relevance, k, lambda_)]
@@ -0,0 +1,193 @@
+"""Atlas Search index definitions for the conversations collection
+
+Creates or validates vector_index and text_index so that both are scoped by
+an indexed contact_id and map only the fields the app searches. An index
+that drifts from these definitions (no contact_id filter, dynamic or
+wildcard mappings, a different similarity) is reported, and replaced with
+--apply.
+
+Usage:
+    python search_indexes.py            # report missing or drifted indexes
+    python search_indexes.py --apply    # create or update them
+"""
+
+import argparse
+import os
+
+from pymongo import ASCENDING, MongoClient
+from pymongo.operations import SearchIndexModel
+
+from hybrid_search import TEXT_SEARCH_PATHS
+
+VECTOR_INDEX_NAME = "vector_index"
+TEXT_INDEX_NAME = "text_index"
+EMBEDDING_DIMENSIONS = 768  # models/text-embedding-004
+VECTOR_SIMILARITY = "cosine"
+TEXT_ANALYZER = "lucene.standard"
+
+
+def vector_index_definition(
+    num_dimensions=EMBEDDING_DIMENSIONS, similarity=VECTOR_SIMILARITY
+):
+    """$vectorSearch index over embedding, pre-filterable by contact_id"""
+    return {
+        "fields": [
+            {
+                "type": "vector",
+                "path": "embedding",
+                "numDimensions": num_dimensions,
+                "similarity": similarity,
+            },
+            {"type": "filter", "path": "contact_id"},
+        ]
+    }
+
+
+def _mapped_field(path, leaf):
+    """Nest a dotted path into Atlas Search static mappings"""
+    head, _, rest = path.partition(".")
+    if not rest:
+        return {head: leaf}
+    return {head: {"type": "document", "fields": _mapped_field(rest, leaf)}}
+
+
+def text_index_definition(analyzer=TEXT_ANALYZER):
+    """$search index mapping only the searched text and the contact_id filter"""
+    fields = {"contact_id": {"type": "number"}}
+    for path in TEXT_SEARCH_PATHS:
+        fields.update(_mapped_field(path, {"type": "string", "analyzer": analyzer}))
+    return {"mappings": {"dynamic": False, "fields": fields}}
+
+
+def expected_indexes(num_dimensions=EMBEDDING_DIMENSIONS, similarity=VECTOR_SIMILARITY):
+    """name -> (type, definition) for every search index the app relies on"""
+    return {
+        VECTOR_INDEX_NAME: (
+            "vectorSearch",
+            vector_index_definition(num_dimensions, similarity),
+        ),
+        TEXT_INDEX_NAME: ("search", text_index_definition()),
+    }
+
+
+def _fields_by_path(definition):
+    return {field["path"]: field for field in definition.get("fields", [])}
+
+
+def validate_vector_index(definition, num_dimensions, similarity):
+    """Return a list of problems with an existing vector index definition"""
+    problems = []
+    fields = _fields_by_path(definition)
+    vector = fields.get("embedding")
+    if not vector or vector.get("type") != "vector":
+        problems.append("embedding is not indexed as a vector")
+    else:
+        if vector.get("numDimensions") != num_dimensions:
+            problems.append(
+                f"numDimensions is {vector.get('numDimensions')}, "
+                f"expected {num_dimensions}"
+            )
+        if vector.get("similarity") != similarity:
+            problems.append(
+                f"similarity is {vector.get('similarity')}, expected {similarity}"
+            )
+    if fields.get("contact_id", {}).get("type") != "filter":
+        problems.append("contact_id is not a filter field")
+    return problems
+
+
+def validate_text_index(definition):
+    """Return a list of problems with an existing text index definition"""
+    problems = []
+    mappings = definition.get("mappings", {})
+    if mappings.get("dynamic", False):
+        problems.append("mappings are dynamic (every field is indexed)")
+    fields = mappings.get("fields", {})
+    if fields.get("contact_id", {}).get("type") != "number":
+        problems.append("contact_id is not mapped as a number for filtering")
+    for path in TEXT_SEARCH_PATHS:
+        node = {"fields": fields}
+        for part in path.split("."):
+            node = node.get("fields", {}).get(part, {})
+        if node.get("type") != "string":
+            problems.append(f"{path} is not mapped as a string")
+    return problems
+
+
+def check_indexes(
+    collection, num_dimensions=EMBEDDING_DIMENSIONS, similarity=VECTOR_SIMILARITY
+):
+    """Return name -> list of problems for the collection's search indexes
+
+    A missing index is reported as ["missing"]; an index with no problems
+    maps to an empty list.
+    """
+    existing = {index["name"]: index for index in collection.list_search_indexes()}
+    report = {}
+    for name, (index_type, _) in expected_indexes(num_dimensions, similarity).items():
+        index = existing.get(name)
+        if index is None:
+            report[name] = ["missing"]
+            continue
+        definition = index.get("latestDefinition", {})
+        if index_type == "vectorSearch":
+            report[name] = validate_vector_index(definition, num_dimensions, similarity)
+        else:
+            report[name] = validate_text_index(definition)
+    return report
+
+
+def ensure_indexes(
+    collection, num_dimensions=EMBEDDING_DIMENSIONS, similarity=VECTOR_SIMILARITY
+):
+    """Create missing search indexes and update drifted ones
+
+    Also creates the regular contact_id index used by the find()-based
+    paths. Returns the report from before the changes.
+    """
+    collection.create_index([("contact_id", ASCENDING)])
+    report = check_indexes(collection, num_dimensions, similarity)
+    expected = expected_indexes(num_dimensions, similarity)
+    for name, problems in report.items():
+        index_type, definition = expected[name]
+        if problems == ["missing"]:
+            collection.create_search_index(
+                SearchIndexModel(definition=definition, name=name, type=index_type)
+            )
+        elif problems:
+            collection.update_search_index(name, definition)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"))
+    parser.add_argument("--db", default="conversations_db")
+    parser.add_argument("--collection", default="conversations")
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    parser.add_argument("--similarity", default=VECTOR_SIMILARITY)
+    parser.add_argument(
+        "--apply", action="store_true", help="create or update drifted indexes"
+    )
+    args = parser.parse_args()
+    if not args.uri:
+        parser.error("MONGODB_URI must be set (or passed)")
+
+    collection = MongoClient(args.uri)[args.db][args.collection]
+    if args.apply:
+        report = ensure_indexes(collection, args.dimensions, args.similarity)
+    else:
+        report = check_indexes(collection, args.dimensions, args.similarity)
+
+    for name, problems in report.items():
+        if not problems:
+            print(f"{name}: ok")
+            continue
+        action = "fixed" if args.apply else "needs --apply"
+        print(f"{name} ({action}): {'; '.join(problems)}")
+    if not args.apply and any(report.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Coalescing of identical concurrent calls ("single flight")
+
+While a call for a key is in flight, later calls with the same key wait for
+its outcome instead of repeating the work. Nothing is cached: once the
+leader finishes, the next call for the key starts a new flight. Results are
+shared between the callers, so treat them as read-only.
+"""
+
+import threading
+from concurrent.futures import Future
+
+import tracing
+
+
+class SingleFlight:
+    """In-flight calls by key, each with a Future its followers wait on"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "followers": 0, "errors": 0}
+
+    def begin(self, key):
+        """Join the flight for key, returning (future, is_leader)
+
+        The leader must call finish() exactly once; followers wait on the
+        future.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+        if not leader:
+            tracing.set_attrs(coalesced=True)
+        return future, leader
+
+    def finish(self, key, future, result=None, error=None):
+        """Publish the leader's outcome and close the flight"""
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+            if error is not None:
+                self.stats["errors"] += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn, or wait for the identical call already running"""
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
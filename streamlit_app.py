@@ -1,16 +1,30 @@
 import streamlit as st
 from dotenv import load_dotenv
 import os
-import re
 from datetime import datetime
 import html
+from citations import parse_answer, resolve_citations
+import tracing
+from providers import require_setting
 from functions import (
     init_mongodb,
-    get_all_clients,
-    get_embedding,
-    find_similar_conversations,
+    get_clients_page,
+    CLIENT_PAGE_SIZE,
+    retrieve_conversations,
     format_context,
-    get_gemini_response,
+    get_gemini_response_stream,
+    get_client_data_version,
+    get_cached_answer,
+    get_semantic_cached_answer,
+    history_fingerprint,
+    cache_answer,
+    new_history_summary,
+    update_history_summary,
+    start_request_trace,
+    get_rate_limit_stats,
+    get_single_flight_stats,
+    ADMIN_PANEL,
+    TRACE_PANEL_SIZE,
 )
 
 # Load environment variables
@@ -352,10 +366,10 @@ if "conversation_history" not in st.session_state:
     st.session_state.conversation_history = []
 if "selected_client" not in st.session_state:
     st.session_state.selected_client = None
-
-
-# Password configuration
-PASSWORD = st.secrets["APP_PASSWORD"]
+if "history_summary" not in st.session_state:
+    st.session_state.history_summary = new_history_summary()
+if "traces" not in st.session_state:
+    st.session_state.traces = []
 
 
 def authenticate():
@@ -367,7 +381,7 @@ def authenticate():
     password = st.text_input("הכנס סיסמה:", type="password", key="password_input")
 
     if st.button("כניסה"):
-        if password == PASSWORD:
+        if password == require_setting("APP_PASSWORD"):
             st.session_state.authenticated = True
             st.rerun()
         else:
@@ -483,170 +497,98 @@ def format_raw_context(similar_convs):
     return html_output
 
 
-def display_response_with_citations(response_text, context):
-    # Split the response into main content and sources
-    parts = response_text.split("מקורות:")
-    main_content = parts[0].strip()
-    sources = parts[1].strip() if len(parts) > 1 else ""
-
-    # Display main content
-    st.markdown(format_message(main_content), unsafe_allow_html=True)
-
-    # Display sources in an expander
-    with st.expander("📚 מקורות ואסמכתאות"):
-        # Parse and display each source with the full conversation
-        for line in sources.split("\n"):
-            if line.strip():
-                # Extract citation number and date
-                citation_match = re.match(
-                    r"\[(\d+)\] שיחה מתאריך (\d{4}-\d{2}-\d{2})", line
-                )
-                if citation_match:
-                    citation_num = citation_match.group(1)
-                    date = citation_match.group(2)
-
-                    # Find the corresponding conversation in context
-                    cited_conv = next(
-                        (
-                            conv
-                            for conv in context
-                            if conv["timestamp"].startswith(date)
-                        ),
-                        None,
-                    )
-
-                    if cited_conv:
-                        st.markdown("---")
-                        st.markdown(f"### ציטוט [{citation_num}]")
-                        st.markdown(f"**תאריך:** {cited_conv['timestamp']}")
-
-                        # Display the conversation messages
-                        for msg in cited_conv["conversation"]:
-                            # Check if the role contains any user-related keywords
-                            is_user = any(
-                                user_role in msg["role"].lower()
-                                for user_role in ["user", "customer", "client", "human"]
-                            )
-
-                            role_icon = "👤" if is_user else "🤖"
-                            role_name = "לקוח" if is_user else "נציג"
-                            bg_color = "#f5f5f5" if is_user else "#e3f2fd"
-
-                            st.markdown(
-                                f"""
-                                <div style='padding: 10px; border-radius: 5px; margin: 5px 0;
-                                    background-color: {bg_color}'>
-                                    <strong>{role_icon} {role_name}</strong><br>
-                                    {msg["content"]}
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
+def has_hebrew(text):
+    """Check whether text contains Hebrew characters"""
+    return any("\u0590" <= c <= "\u05ff" for c in text)
 
 
-def main():
-    # Check authentication before showing the main app
-    if not authenticate():
-        return
-    st.title("💬 ניתוח צ'אט תמיכת לקוחות")
+def render_citations_html(citations, context):
+    """Render the cited conversations into a single HTML block"""
+    html_output = ""
+    for citation_num, cited_conv in resolve_citations(citations, context):
+        html_output += f"""
+        <hr>
+        <h3>ציטוט [{citation_num}]</h3>
+        <p><strong>תאריך:</strong> {cited_conv['timestamp']}</p>
+        """
 
-    # Initialize MongoDB connection
-    collection = init_mongodb()
-
-    # Sidebar for client selection
-    with st.sidebar:
-        st.title("בחירת לקוח")
-        clients = get_all_clients(collection)
-        selected_client = st.selectbox("בחר מזהה לקוח:", clients)
-
-    # Display conversation history
-    for message in st.session_state.conversation_history:
-        with st.chat_message(message["role"]):
-            # For assistant messages, split content and sources
-            if message["role"] == "assistant" and "context" in message:
-                parts = message["content"].split("מקורות:")
-                main_content = parts[0].strip()
-                sources = parts[1].strip() if len(parts) > 1 else ""
-
-                # Display main content
-                has_hebrew = any("\u0590" <= c <= "\u05FF" for c in main_content)
-                st.markdown(
-                    format_message(main_content, is_hebrew=has_hebrew),
-                    unsafe_allow_html=True,
-                )
-
-                # Display sources in an expander
-                if sources:
-                    with st.expander("📚 מקורות ואסמכתאות"):
-                        for line in sources.split("\n"):
-                            if line.strip():
-                                citation_match = re.match(
-                                    r"\[(\d+)\] שיחה מתאריך (\d{4}-\d{2}-\d{2})", line
-                                )
-                                if citation_match:
-                                    citation_num = citation_match.group(1)
-                                    date = citation_match.group(2)
-
-                                    cited_conv = next(
-                                        (
-                                            conv
-                                            for conv in message["context"]
-                                            if conv["timestamp"].startswith(date)
-                                        ),
-                                        None,
-                                    )
-
-                                    if cited_conv:
-                                        st.markdown("---")
-                                        st.markdown(f"### ציטוט [{citation_num}]")
-                                        st.markdown(
-                                            f"**תאריך:** {cited_conv['timestamp']}"
-                                        )
-
-                                        for msg in cited_conv["conversation"]:
-                                            is_user = any(
-                                                user_role in msg["role"].lower()
-                                                for user_role in [
-                                                    "user",
-                                                    "customer",
-                                                    "client",
-                                                    "human",
-                                                ]
-                                            )
-
-                                            role_icon = "👤" if is_user else "🤖"
-                                            role_name = "לקוח" if is_user else "נציג"
-                                            bg_color = (
-                                                "#f5f5f5" if is_user else "#e3f2fd"
-                                            )
-
-                                            st.markdown(
-                                                f"""
-                                                <div style='padding: 10px; border-radius: 5px; margin: 5px 0;
-                                                    background-color: {bg_color}'>
-                                                    <strong>{role_icon} {role_name}</strong><br>
-                                                    {msg["content"]}
-                                                </div>
-                                                """,
-                                                unsafe_allow_html=True,
-                                            )
-            else:
-                # For user messages, just display the content
-                has_hebrew = any("\u0590" <= c <= "\u05FF" for c in message["content"])
-                st.markdown(
-                    format_message(message["content"], is_hebrew=has_hebrew),
-                    unsafe_allow_html=True,
-                )
+        for msg in cited_conv["conversation"]:
+            # Check if the role contains any user-related keywords
+            is_user = any(
+                user_role in msg["role"].lower()
+                for user_role in ["user", "customer", "client", "human"]
+            )
 
-    # Chat input with RTL support
-    question = st.chat_input("שאל שאלה על השיחות...")
+            role_icon = "👤" if is_user else "🤖"
+            role_name = "לקוח" if is_user else "נציג"
+            bg_color = "#f5f5f5" if is_user else "#e3f2fd"
 
-    if question:
-        # Get fresh context for the new question
-        query_embedding = get_embedding(question)
-        similar_convs = find_similar_conversations(
+            safe_content = html.escape(msg["content"])
+            safe_content = safe_content.replace("\\n", "<br>").replace("\n", "<br>")
+
+            html_output += f"""
+            <div style='padding: 10px; border-radius: 5px; margin: 5px 0;
+                background-color: {bg_color}'>
+                <strong>{role_icon} {role_name}</strong><br>
+                {safe_content}
+            </div>
+            """
+
+    return html_output
+
+
+def get_turn_html(message):
+    """Render a chat turn to HTML once and memoize it on the message"""
+    if "html" not in message:
+        # Older answers carry their sources inside the text
+        if message["role"] == "assistant" and "citations" not in message:
+            message["content"], message["citations"] = parse_answer(message["content"])
+        message["html"] = format_message(
+            message["content"], is_hebrew=has_hebrew(message["content"])
+        )
+    return message["html"]
+
+
+@st.fragment
+def display_sources(turn_key, message):
+    """Show an answer's cited conversations, rendered only when first opened"""
+    if not message.get("citations"):
+        return
+
+    if st.toggle("📚 מקורות ואסמכתאות", key=f"sources_{turn_key}"):
+        if "sources_html" not in message:
+            message["sources_html"] = render_citations_html(
+                message["citations"], message["context"]
+            )
+        st.markdown(message["sources_html"], unsafe_allow_html=True)
+
+
+def display_turn(turn_key, message):
+    """Display one chat turn from its memoized HTML"""
+    with st.chat_message(message["role"]):
+        st.markdown(get_turn_html(message), unsafe_allow_html=True)
+        if message["role"] == "assistant" and "context" in message:
+            display_sources(turn_key, message)
+
+
+def answer_question(collection, selected_client, question):
+    """Retrieve context for a new question and stream the answer as a new turn"""
+    history = st.session_state.conversation_history
+    data_version = get_client_data_version(collection, selected_client)
+    # Cached answers are only reused after the same earlier turns
+    history_key = history_fingerprint(history, st.session_state.history_summary)
+
+    # Near-duplicate questions can reuse a cached answer without retrieval
+    cached_answer = get_semantic_cached_answer(
+        selected_client, question, data_version, history_key
+    )
+    if cached_answer:
+        new_context = cached_answer["context"]
+    else:
+        # Get fresh context for the new question (embedding, vector search
+        # and text search run concurrently)
+        similar_convs = retrieve_conversations(
             collection=collection,
-            query_embedding=query_embedding,
             query_text=question,
             contact_id=selected_client,
             n=100,
@@ -654,108 +596,201 @@ def main():
             text_weight=0.9,
             min_text_score=0.7,
         )
+        cached_answer = get_cached_answer(
+            selected_client, question, similar_convs, data_version, history_key
+        )
 
         # Format the new context
         new_context = format_context(similar_convs) if similar_convs else []
 
-        # Display user message
-        with st.chat_message("user"):
-            st.markdown(format_message(question), unsafe_allow_html=True)
+    # Add user message to history without context and display it
+    history.append({"role": "user", "content": question})
+    display_turn(len(history) - 1, history[-1])
 
-        # Add user message to history without context
-        st.session_state.conversation_history.append(
-            {"role": "user", "content": question}
+    if not new_context:
+        with st.chat_message("assistant"):
+            response_text = f"לא נמצאו שיחות עבור לקוח {selected_client}"
+            st.warning(format_message(response_text), unsafe_allow_html=True)
+        return
+
+    if cached_answer:
+        response = cached_answer
+    else:
+        # Stream the answer as it is generated; the placeholder is replaced
+        # by the rendered turn once it completes
+        response = get_gemini_response_stream(
+            question,
+            new_context,  # Use the fresh context
+            history,  # Recent turns verbatim, older turns via the summary
+            history_summary=st.session_state.history_summary,
+            contact_id=selected_client,
+            data_version=data_version,
+        )
+        answer_placeholder = st.empty()
+        with answer_placeholder.container():
+            with st.chat_message("assistant"):
+                st.write_stream(response["stream"])
+        answer_placeholder.empty()
+        cache_answer(
+            selected_client,
+            question,
+            similar_convs,
+            {
+                "text": response["text"],
+                "citations": response["citations"],
+                "context_report": response["context_report"],
+                "context": new_context,
+            },
+            data_version,
+            history_key,
         )
 
-        # Process the question with fresh context
-        with st.chat_message("assistant"):
-            with st.spinner("מעבד..."):
-                if not similar_convs:
-                    response_text = f"לא נמצאו שיחות עבור לקוח {selected_client}"
-                    st.warning(format_message(response_text), unsafe_allow_html=True)
-                else:
-                    # Get response using conversation history but new context
-                    response = get_gemini_response(
-                        question,
-                        new_context,  # Use the fresh context
-                        st.session_state.conversation_history,  # Pass full conversation history
-                    )
-
-                    # Split and display current response with sources
-                    parts = response["text"].split("מקורות:")
-                    main_content = parts[0].strip()
-                    sources = parts[1].strip() if len(parts) > 1 else ""
-
-                    # Display main content
-                    st.markdown(format_message(main_content), unsafe_allow_html=True)
-
-                    # Display sources in an expander
-                    if sources:
-                        with st.expander("📚 מקורות ואסמכתאות"):
-                            for line in sources.split("\n"):
-                                if line.strip():
-                                    citation_match = re.match(
-                                        r"\[(\d+)\] שיחה מתאריך (\d{4}-\d{2}-\d{2})",
-                                        line,
-                                    )
-                                    if citation_match:
-                                        citation_num = citation_match.group(1)
-                                        date = citation_match.group(2)
-
-                                        cited_conv = next(
-                                            (
-                                                conv
-                                                for conv in new_context
-                                                if conv["timestamp"].startswith(date)
-                                            ),
-                                            None,
-                                        )
-
-                                        if cited_conv:
-                                            st.markdown("---")
-                                            st.markdown(f"### ציטוט [{citation_num}]")
-                                            st.markdown(
-                                                f"**תאריך:** {cited_conv['timestamp']}"
-                                            )
-
-                                            for msg in cited_conv["conversation"]:
-                                                is_user = any(
-                                                    user_role in msg["role"].lower()
-                                                    for user_role in [
-                                                        "user",
-                                                        "customer",
-                                                        "client",
-                                                        "human",
-                                                    ]
-                                                )
-
-                                                role_icon = "👤" if is_user else "🤖"
-                                                role_name = (
-                                                    "לקוח" if is_user else "נציג"
-                                                )
-                                                bg_color = (
-                                                    "#f5f5f5" if is_user else "#e3f2fd"
-                                                )
-
-                                                st.markdown(
-                                                    f"""
-                                                    <div style='padding: 10px; border-radius: 5px; margin: 5px 0;
-                                                        background-color: {bg_color}'>
-                                                        <strong>{role_icon} {role_name}</strong><br>
-                                                        {msg["content"]}
-                                                    </div>
-                                                    """,
-                                                    unsafe_allow_html=True,
-                                                )
-
-                    # Add assistant response to history with the new context
-                    st.session_state.conversation_history.append(
-                        {
-                            "role": "assistant",
-                            "content": response["text"],
-                            "context": new_context,  # Store the fresh context
-                        }
-                    )
+    # Add assistant response to history with the new context and display it
+    history.append(
+        {
+            "role": "assistant",
+            "content": response["text"],
+            "citations": response["citations"],
+            "context": new_context,  # Store the fresh context
+        }
+    )
+    display_turn(len(history) - 1, history[-1])
+
+    # Fold older turns into the rolling summary without delaying this answer
+    update_history_summary(st.session_state.history_summary, history)
+
+    # Let the analyst know when the context had to be trimmed
+    report = response.get("context_report")
+    if report and report["dropped"]:
+        st.caption(
+            f"הוקשרו {len(report['included'])} מתוך "
+            f"{len(new_context)} שיחות (מגבלת אורך הקשר)"
+        )
+    if report and report.get("chunks"):
+        st.caption(f"התשובה מוזגה מ-{report['chunks']} חלקים של השיחות")
+
+
+@st.fragment
+def chat_fragment(collection, selected_client):
+    """Chat input and new turns; reruns on its own without redrawing history"""
+    history = st.session_state.conversation_history
+
+    # Turns added by earlier runs of this fragment since the last full rerun
+    for turn_key in range(st.session_state.rendered_turns, len(history)):
+        display_turn(turn_key, history[turn_key])
+
+    # Chat input with RTL support
+    question = st.chat_input("שאל שאלה על השיחות...")
+    if question:
+        profile = st.session_state.pop("profile_next_question", False)
+        with start_request_trace(
+            "question",
+            profile=profile,
+            contact_id=selected_client,
+            question_chars=len(question),
+        ) as trace:
+            answer_question(collection, selected_client, question)
+        record_trace(trace)
+
+
+def record_trace(trace):
+    """Keep a finished question trace for the admin panel"""
+    traces = st.session_state.traces
+    traces.append({**trace.to_dict(), "profile": trace.profile})
+    del traces[:-TRACE_PANEL_SIZE]
+
+
+def request_profile():
+    st.session_state.profile_next_question = True
+
+
+def display_admin_panel():
+    """Sidebar breakdown of the last questions' spans, errors and profiles"""
+    with st.expander("⏱️ ביצועים"):
+        if st.session_state.get("profile_next_question"):
+            st.caption("השאלה הבאה תרוץ עם cProfile")
+        else:
+            st.button("📸 פרופיל לשאלה הבאה", on_click=request_profile)
+
+        for name, stats in get_rate_limit_stats().items():
+            st.caption(
+                f"{name}: {stats['calls']} calls, {stats['in_flight']} in flight, "
+                f"wait avg {stats['wait_ms_avg']:.0f} ms / max "
+                f"{stats['wait_ms_max']:.0f} ms, {stats['retries']} retries, "
+                f"{stats['failures']} failures"
+            )
+        for name, stats in get_single_flight_stats().items():
+            st.caption(
+                f"{name}: {stats['followers']} coalesced of "
+                f"{stats['leaders'] + stats['followers']} requests"
+            )
+
+        if not st.session_state.traces:
+            st.caption("אין עדיין שאלות")
+            return
+        for trace in reversed(st.session_state.traces):
+            started = datetime.fromtimestamp(trace["started_at"]).strftime("%H:%M:%S")
+            st.markdown(f"**{started} · {trace['duration_ms']:.0f} ms**")
+            st.dataframe(
+                [
+                    {
+                        "stage": span["name"],
+                        "ms": span["duration_ms"],
+                        "start": span["start_ms"],
+                        "details": ", ".join(
+                            f"{k}={v}" for k, v in span["attrs"].items()
+                        ),
+                    }
+                    for span in trace["spans"]
+                ],
+                hide_index=True,
+            )
+            for error in trace["errors"]:
+                st.caption(f"⚠️ {error['stage']}: {error['type']}: {error['message']}")
+            if trace["profile"]:
+                st.code(trace["profile"], language=None)
+
+
+def main():
+    # Check authentication before showing the main app
+    if not authenticate():
+        return
+    st.title("💬 ניתוח צ'אט תמיכת לקוחות")
+
+    # Page reruns happen on every interaction, so only questions are logged
+    with start_request_trace("page", log=False):
+        # Initialize MongoDB connection
+        collection = init_mongodb()
+
+        # Sidebar for client selection
+        with st.sidebar, tracing.span("sidebar"):
+            st.title("בחירת לקוח")
+            search = st.text_input("חיפוש מזהה לקוח:", key="client_search")
+            page = st.number_input(
+                "עמוד:", min_value=1, value=1, step=1, key="client_page"
+            )
+            clients, total_clients = get_clients_page(
+                search.strip(), int(page) - 1, CLIENT_PAGE_SIZE
+            )
+            total_pages = max(1, -(-total_clients // CLIENT_PAGE_SIZE))
+            st.caption(f"{total_clients} לקוחות · עמוד {int(page)} מתוך {total_pages}")
+            selected_client = st.selectbox("בחר מזהה לקוח:", clients)
+            if ADMIN_PANEL:
+                display_admin_panel()
+
+        if selected_client is None:
+            st.info("לא נמצאו לקוחות")
+            return
+
+        # Display conversation history from memoized HTML; new questions only
+        # rerun the chat fragment below
+        history = st.session_state.conversation_history
+        st.session_state.rendered_turns = len(history)
+        with tracing.span("render_history", turns=len(history)):
+            for turn_key, message in enumerate(history):
+                display_turn(turn_key, message)
+
+    chat_fragment(collection, selected_client)
 
 
 # def main():
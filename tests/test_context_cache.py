@@ -0,0 +1,107 @@
+"""ClientContextCache against a fake genai client that records its calls"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import tracing
+from context_cache import ClientContextCache
+
+
+class FakeCaches:
+    def __init__(self, fail=False, delay=0.0):
+        self.fail = fail
+        self.delay = delay
+        self.created = []
+        self.deleted = []
+        self._lock = threading.Lock()
+
+    def create(self, model, config):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("content too small to cache")
+        with self._lock:
+            name = f"cachedContents/{len(self.created)}"
+            self.created.append((model, config.display_name, name))
+        return SimpleNamespace(name=name)
+
+    def delete(self, name):
+        with self._lock:
+            self.deleted.append(name)
+
+
+def make_cache(**kwargs):
+    client = SimpleNamespace(caches=FakeCaches(**kwargs))
+    return ClientContextCache(lambda: client, "gemini-test", ttl_seconds=60), client
+
+
+def corpus(ids=(1, 2)):
+    return lambda: ("corpus", list(ids))
+
+
+def test_reuses_entry_until_data_version_changes():
+    cache, client = make_cache()
+
+    first = cache.get_or_create(7, (2, 100), corpus())
+    again = cache.get_or_create(7, (2, 100), corpus())
+    assert again is first
+    assert first["conversation_ids"] == {1, 2}
+    assert client.caches.created == [("gemini-test", "client-7", "cachedContents/0")]
+
+    updated = cache.get_or_create(7, (3, 200), corpus((1, 2, 3)))
+    assert updated["name"] == "cachedContents/1"
+    assert client.caches.deleted == ["cachedContents/0"]
+
+
+def test_concurrent_misses_for_one_client_create_once():
+    cache, client = make_cache(delay=0.2)
+    results = []
+
+    def use():
+        results.append(cache.get_or_create(7, (2, 100), corpus()))
+
+    threads = [threading.Thread(target=use) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(client.caches.created) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_slow_build_does_not_block_other_clients():
+    cache, client = make_cache()
+    release = threading.Event()
+
+    def slow_corpus():
+        release.wait(5)
+        return "corpus", [1]
+
+    slow = threading.Thread(target=cache.get_or_create, args=(7, (1, 1), slow_corpus))
+    slow.start()
+    try:
+        started = time.monotonic()
+        entry = cache.get_or_create(8, (1, 1), corpus())
+        assert time.monotonic() - started < 1
+        assert entry["name"] == "cachedContents/0"
+    finally:
+        release.set()
+        slow.join()
+    assert len(client.caches.created) == 2
+
+
+def test_failed_create_is_reported_and_remembered():
+    cache, client = make_cache(fail=True)
+    builds = []
+
+    def counting_corpus():
+        builds.append(1)
+        return "corpus", [1]
+
+    with tracing.start_trace("question") as trace:
+        assert cache.get_or_create(7, (1, 1), counting_corpus) is None
+        assert cache.get_or_create(7, (1, 1), counting_corpus) is None
+
+    assert len(builds) == 1
+    assert [error["stage"] for error in trace.errors] == ["Context cache create"]
@@ -0,0 +1,74 @@
+"""LocalTextIndex refreshes against a mongomock collection"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from lexical_index import LocalTextIndex
+
+mongomock = pytest.importorskip("mongomock")
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+
+def write(collection, conversation_id, text, end_time, updated_at):
+    collection.update_one(
+        {"conversation_id": conversation_id},
+        {
+            "$set": {
+                "conversation_id": conversation_id,
+                "contact_id": 7,
+                "start_time": end_time - 1,
+                "end_time": end_time,
+                "messages": [{"role": "user", "content": text}],
+                "updated_at": updated_at,
+            }
+        },
+        upsert=True,
+    )
+
+
+def found(index, collection, query):
+    return [hit["conversation_id"] for hit in index.search(collection, 7, query)]
+
+
+@pytest.fixture
+def collection():
+    collection = mongomock.MongoClient().db.conversations
+    write(collection, 1, "redemption request", 2000, NOW)
+    write(collection, 2, "deposit question", 3000, NOW)
+    return collection
+
+
+def test_backfilled_old_conversation_becomes_searchable(collection):
+    index = LocalTextIndex(refresh_interval=0)
+    assert found(index, collection, "transfer") == []
+
+    # Ends before everything indexed so far, but is written now
+    write(collection, 3, "transfer fee", 1000, NOW + timedelta(minutes=1))
+    assert found(index, collection, "transfer") == [3]
+
+
+def test_reingested_conversation_is_reindexed(collection):
+    index = LocalTextIndex(refresh_interval=0)
+    assert found(index, collection, "redemption") == [1]
+
+    write(collection, 1, "withdrawal request", 2000, NOW + timedelta(minutes=1))
+    assert found(index, collection, "redemption") == []
+    assert found(index, collection, "withdrawal") == [1]
+
+
+def test_deleted_conversation_is_dropped(collection):
+    index = LocalTextIndex(refresh_interval=0)
+    assert found(index, collection, "deposit") == [2]
+
+    collection.delete_one({"conversation_id": 2})
+    assert found(index, collection, "deposit") == []
+
+
+def test_refresh_waits_for_the_interval(collection):
+    index = LocalTextIndex(refresh_interval=3600)
+    found(index, collection, "transfer")
+
+    write(collection, 3, "transfer fee", 1000, NOW + timedelta(minutes=1))
+    assert found(index, collection, "transfer") == []
@@ -0,0 +1,246 @@
+"""Lightweight per-request tracing: timing spans, errors and JSONL logs
+
+A trace is started around one unit of work (e.g. answering a question) with
+start_trace(); functions decorated with @traced, and `with span(...)` blocks,
+record nested timing spans into it. Outside of a trace, spans cost one
+context variable lookup and record nothing.
+"""
+
+import cProfile
+import functools
+import io
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+_current_trace = ContextVar("trace", default=None)
+# (span id, attrs) of the innermost open span
+_current_span = ContextVar("span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Trace:
+    """Spans, errors and attributes recorded for one unit of work"""
+
+    def __init__(self, name, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.errors = []
+        self.profile = None
+        self.started_at = time.time()
+        self.duration_ms = None
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def add_error(self, record):
+        with self._lock:
+            self.errors.append(record)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._t0) * 1000
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "trace_id": self.id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration_ms": self.duration_ms,
+                "attrs": dict(self.attrs),
+                "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+                "errors": list(self.errors),
+            }
+
+
+class TraceLog:
+    """Appends finished traces to a JSONL file (path=None disables it)"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, trace):
+        if not self.path:
+            return
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            print(f"Trace log error: {e}")
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def active():
+    """Whether a trace is being recorded in this context"""
+    return _current_trace.get() is not None
+
+
+@contextmanager
+def start_trace(name, log=None, profile=False, **attrs):
+    """Record a new trace for the enclosed block and yield it
+
+    The trace is written to log (a TraceLog) when the block exits. With
+    profile=True the block is also run under cProfile and the top functions
+    by cumulative time are kept on trace.profile (only the calling thread is
+    profiled).
+    """
+    trace = Trace(name, **attrs)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield trace
+    except Exception as e:
+        trace.add_error(_error_record(name, e))
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+            trace.profile = out.getvalue()
+        trace.duration_ms = round(trace.elapsed_ms(), 3)
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        if log is not None:
+            log.write(trace)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the enclosed block as a span of the current trace
+
+    Yields the span's attribute dict so counts can be added while it runs.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+
+    span_id = next(_span_ids)
+    parent = _current_span.get()
+    token = _current_span.set((span_id, attrs))
+    start_ms = trace.elapsed_ms()
+    error = None
+    try:
+        yield attrs
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        record = {
+            "id": span_id,
+            "parent": parent[0] if parent else None,
+            "name": name,
+            "start_ms": round(start_ms, 3),
+            "duration_ms": round(trace.elapsed_ms() - start_ms, 3),
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+        }
+        if error:
+            record["error"] = error
+        trace.add_span(record)
+
+
+def record_span(name, started, **attrs):
+    """Record a span timed by hand from started (a perf_counter() value)
+
+    For work that cannot sit inside a `with span(...)` block, such as a
+    generator that yields to its caller between chunks.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    parent = _current_span.get()
+    trace.add_span(
+        {
+            "id": next(_span_ids),
+            "parent": parent[0] if parent else None,
+            "name": name,
+            "start_ms": round(trace.elapsed_ms() - duration_ms, 3),
+            "duration_ms": round(duration_ms, 3),
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+        }
+    )
+
+
+def set_attrs(**attrs):
+    """Add attributes to the innermost span (or to the trace itself)"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    current = _current_span.get()
+    if current is None:
+        trace.attrs.update(attrs)
+    else:
+        current[1].update(attrs)
+
+
+def traced(name=None):
+    """Decorator recording each call as a span
+
+    List results add a "results" count to the span.
+    """
+
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(span_name) as attrs:
+                result = fn(*args, **kwargs)
+                if isinstance(result, list):
+                    attrs["results"] = len(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def _error_record(stage, error):
+    current = _current_span.get()
+    return {
+        "stage": stage,
+        "type": type(error).__name__,
+        "message": str(error),
+        "span": current[0] if current else None,
+    }
+
+
+def report_error(stage, error):
+    """Log a handled error and record which stage it came from"""
+    print(f"{stage} error: {error}")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_error(_error_record(stage, error))
+
+
+def submit(pool, fn, *args, **kwargs):
+    """Submit to an executor so the task records spans into the current trace"""
+    return pool.submit(copy_context().run, fn, *args, **kwargs)
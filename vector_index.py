@@ -0,0 +1,162 @@
+"""In-process vector search over a client's conversation embeddings"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from hybrid_search import LEAN_PROJECTION
+
+
+def normalize_rows(matrix):
+    """L2-normalize each row so dot products are cosine similarities"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first, without a full sort"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class LocalVectorIndex:
+    """Per-client float32 embedding matrices cached in memory
+
+    Each client's embeddings are loaded once into a contiguous, row-normalized
+    float32 matrix alongside the lean hit fields, and searched with a single
+    matrix-vector product plus argpartition. Entries are keyed by collection
+    name and contact_id, expire after ttl_seconds, and the least recently used
+    clients are evicted beyond max_clients.
+    """
+
+    def __init__(self, ttl_seconds=300, max_clients=32):
+        self.ttl_seconds = ttl_seconds
+        self.max_clients = max_clients
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, collection, contact_id):
+        """Load one client's embeddings into a normalized float32 matrix"""
+        projection = {**LEAN_PROJECTION, "embedding": 1}
+        hits = []
+        vectors = []
+        for doc in collection.find(
+            {"contact_id": contact_id, "embedding": {"$exists": True}}, projection
+        ):
+            vectors.append(doc.pop("embedding"))
+            hits.append(doc)
+        if vectors:
+            matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+        return {
+            "hits": hits,
+            "matrix": np.ascontiguousarray(matrix),
+            "rows": {hit["conversation_id"]: i for i, hit in enumerate(hits)},
+            "loaded_at": time.monotonic(),
+        }
+
+    def get(self, collection, contact_id):
+        """Return the cached hits and matrix for a client, loading if needed"""
+        key = (collection.name, contact_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["loaded_at"] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._load(collection, contact_id)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_clients:
+                self._entries.popitem(last=False)
+        return entry
+
+    def search(self, collection, contact_id, query_embedding, n=100):
+        """Return the top n lean hits by cosine similarity to the query"""
+        entry = self.get(collection, contact_id)
+        if not entry["hits"]:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape != (entry["matrix"].shape[1],):
+            raise ValueError(
+                f"Query has {query.size} dimensions, "
+                f"index has {entry['matrix'].shape[1]}"
+            )
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        scores = entry["matrix"] @ query
+
+        results = []
+        for i in top_k(scores, n):
+            score = float(scores[i])
+            results.append(
+                {
+                    **entry["hits"][i],
+                    "search_score": score,
+                    "vector_score": score,
+                    "text_score": 0,
+                }
+            )
+        return results
+
+    def _cached(self, collection, contact_id):
+        with self._lock:
+            entry = self._entries.get((collection.name, contact_id))
+        if (
+            entry is not None
+            and time.monotonic() - entry["loaded_at"] < self.ttl_seconds
+        ):
+            return entry
+        return None
+
+    def vectors(self, collection, contact_id, conversation_ids):
+        """Normalized embeddings for the given conversations, one row each
+
+        Rows come from the client's cached matrix if it is loaded; otherwise
+        only these conversations' embeddings are fetched, so a client is never
+        loaded in full just for reranking. Conversations without an embedding
+        get a row of zeros.
+        """
+        entry = self._cached(collection, contact_id)
+        if entry is not None:
+            rows = [entry["rows"].get(cid) for cid in conversation_ids]
+            found = {
+                cid: entry["matrix"][row]
+                for cid, row in zip(conversation_ids, rows)
+                if row is not None
+            }
+        else:
+            found = {
+                doc["conversation_id"]: np.asarray(doc["embedding"], dtype=np.float32)
+                for doc in collection.find(
+                    {
+                        "contact_id": contact_id,
+                        "conversation_id": {"$in": list(conversation_ids)},
+                        "embedding": {"$exists": True},
+                    },
+                    {"_id": 0, "conversation_id": 1, "embedding": 1},
+                )
+            }
+        if not found:
+            return np.zeros((len(conversation_ids), 0), dtype=np.float32)
+
+        dimensions = len(next(iter(found.values())))
+        vectors = np.zeros((len(conversation_ids), dimensions), dtype=np.float32)
+        for i, conversation_id in enumerate(conversation_ids):
+            if conversation_id in found:
+                vectors[i] = found[conversation_id]
+        return normalize_rows(vectors)